@@ -0,0 +1,384 @@
+"""Offline benchmarks for the train_notify pipeline
+
+Times each stage over synthetic realtime feeds, or over feeds recorded with
+ train_notify.py --record-dir, so that performance regressions show up
+ without touching the live feed, the Hue bridge or Pushover.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import conf
+import feed
+import history
+import replay
+import timetable
+import train_notify
+
+DEFAULT_FEED_SIZES = [1000, 10000, 50000, 100000]
+DEFAULT_PIPELINE_FEED_SIZES = [1000, 10000]
+SUITE_SCALING = "scaling"
+SUITE_PIPELINE = "pipeline"
+SUITE_HISTORY = "history"
+SUITE_TIMETABLE = "timetable"
+SUITE_STARTUP = "startup"
+# Modules run from cron every minute, and the most they may take to import
+STARTUP_ENTRY_POINTS = ["train_notify", "weather_notify", "locator"]
+DEFAULT_STARTUP_BUDGET_SECS = 0.15
+# Backend dependencies that must only be imported when they're used
+LAZY_MODULES = ["requests", "phue", "subprocess32", "httplib",
+                "urllib2", "sqlite3", "multiprocessing", "wsgiref",
+                "cProfile", "zipfile"]
+
+# Run in a fresh interpreter. Python 2 has no -X importtime, so __import__
+#  is wrapped to time each module's first import, including the modules it
+#  imports itself.
+IMPORT_TIME_SCRIPT = """
+import __builtin__
+import json
+import sys
+import time
+timings = []
+real_import = __builtin__.__import__
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        timings.append((name, time.time() - start))
+
+__builtin__.__import__ = timed_import
+start = time.time()
+import %s
+total = time.time() - start
+__builtin__.__import__ = real_import
+print json.dumps({"total": total, "timings": timings,
+                  "modules": sorted(sys.modules)})
+"""
+
+
+def synthetic_feed(record_count, route=None, seed=0):
+    """A feed dict with record_count vehicles and matching delays/alerts
+
+    One in four vehicles is on the configured route, and one in ten trips
+     has an alert, which is roughly the shape of a busy multi-route feed.
+    """
+    rng = random.Random(seed)
+    route = route or conf.ROUTES
+    stop_ids = list(conf.stop_ids) or [0]
+    delays = []
+    vehicles = []
+    alerts = []
+    for n in xrange(record_count):
+        trip_id = "trip-%d" % (n,)
+        start_mins = rng.randint(0, 23 * 60)
+        offsets = []
+        for step in xrange(6):
+            offset_mins = start_mins + step * 15
+            offsets.append("%d:%02d" % (offset_mins // 60, offset_mins % 60))
+            offsets.append(str(rng.randint(-2, 20)))
+        delays.append({"tripId": trip_id,
+                       "start": "%d:%02d" % (start_mins // 60,
+                                             start_mins % 60),
+                       "stopId": str(rng.choice(stop_ids)),
+                       "offsets": ",".join(offsets)})
+        vehicles.append({"tripId": trip_id,
+                         "route": route if n % 4 == 0 else "OTHER",
+                         "lp": "Somewhere:%d:%d" % (n, n)})
+        if n % 10 == 0:
+            alerts.append({"tripId": trip_id, "title": "Alert %d" % (n,)})
+    rng.shuffle(delays)
+    rng.shuffle(vehicles)
+    return {"timestamp": time.time(),
+            "delays": delays,
+            "vehicles": vehicles,
+            "alerts": alerts}
+
+
+def time_trip_extraction(j, fdt, ldt):
+    """Seconds taken to index the feed and extract every on-route trip"""
+    start = time.time()
+    feed_index = train_notify.index_feed(j)
+    trips = [train_notify.extract_trip(feed_index, v["tripId"], fdt, ldt)
+             for v in j["vehicles"] if v["route"] == conf.ROUTES]
+    return time.time() - start, len(trips)
+
+
+def run_scaling_benchmark(feed_sizes):
+    fdt = timedelta(hours=7)
+    ldt = timedelta(hours=8)
+    results = []
+    for size in feed_sizes:
+        j = synthetic_feed(size)
+        elapsed, trip_count = time_trip_extraction(j, fdt, ldt)
+        results.append((size, trip_count, elapsed))
+        print "%8d records %7d trips %8.3fs %6.2fus/record" % \
+            (size, trip_count, elapsed, elapsed / size * 1e6)
+
+    # Linear scaling means the per-record cost stays roughly constant as the
+    #  feed grows. Compare the largest feed against the smallest.
+    smallest, largest = results[0], results[-1]
+    ratio = (largest[2] / largest[0]) / (smallest[2] / smallest[0])
+    print "Per-record cost ratio (largest/smallest feed): %.2f" % (ratio,)
+    return results
+
+
+def load_corpus(corpus_path=None, sizes=DEFAULT_PIPELINE_FEED_SIZES):
+    """[(name, feed text)] from recorded snapshots, or synthetic feeds"""
+    if corpus_path:
+        corpus = []
+        for path in replay.snapshot_paths(corpus_path):
+            with open(path) as f:
+                corpus.append((os.path.basename(path), f.read()))
+        return corpus
+    return [("synthetic-%d" % (size,), json.dumps(synthetic_feed(size)))
+            for size in sizes]
+
+
+def time_pipeline(text, lateness_threshold_mins):
+    """Seconds spent in each stage of a run over one feed
+
+    Every trip in the day is in the departure window, so evaluation and
+     notification see as much work as the feed can give them.
+    """
+    timings = {}
+    start = time.time()
+    j = json.loads(text)
+    timings["parse"] = time.time() - start
+
+    # For comparison, parse as --stream would, keeping only our route
+    start = time.time()
+    parser = feed.StreamingFeedParser([conf.ROUTES])
+    if isinstance(text, str):
+        text = text.decode("utf-8")
+    for offset in xrange(0, len(text), feed.STREAM_CHUNK_SIZE):
+        parser.feed(text[offset:offset + feed.STREAM_CHUNK_SIZE])
+    parser.close()
+    timings["stream"] = time.time() - start
+
+    start = time.time()
+    feed_index = train_notify.index_feed(j)
+    trip_ids = train_notify.trip_ids_by_route(j, [conf.ROUTES])[conf.ROUTES]
+    trips = [train_notify.extract_trip(feed_index, trip_id,
+                                       timedelta(0), timedelta(hours=24))
+             for trip_id in trip_ids]
+    timings["extract"] = time.time() - start
+
+    now = train_notify.now_as_timedelta(
+        datetime.fromtimestamp(j["timestamp"]))
+    start = time.time()
+    train_notify.evaluate_trips(trips, lateness_threshold_mins, now)
+    timings["evaluate"] = time.time() - start
+
+    subscription = train_notify.Subscription(
+        conf.ROUTES, timedelta(0), timedelta(hours=24),
+        lateness_threshold_mins, notification_locations=["benchmark"])
+    backends = replay.StubBackends("benchmark", now)
+    start = time.time()
+    train_notify.notify_subscriber(
+        subscription, trips, datetime.fromtimestamp(j["timestamp"]).ctime(),
+        backends.locate(), train_notify.SEND_NOTIFICATION_AUTO, backends, now)
+    timings["notify"] = time.time() - start
+    return len(j["vehicles"]), len(trips), timings
+
+
+def run_pipeline_benchmark(corpus, lateness_threshold_mins, repeat=3):
+    """Best of repeat timings for each stage over each feed in the corpus"""
+    stages = ["parse", "stream", "extract", "evaluate", "notify"]
+    print "%-32s %8s %7s %s" % ("feed", "records", "trips",
+                                " ".join("%9s" % (s,) for s in stages))
+    totals = dict((stage, 0.0) for stage in stages)
+    for name, text in corpus:
+        best = {}
+        for _ in xrange(repeat):
+            record_count, trip_count, timings = time_pipeline(
+                text, lateness_threshold_mins)
+            for stage in stages:
+                best[stage] = min(best.get(stage, timings[stage]),
+                                  timings[stage])
+        for stage in stages:
+            totals[stage] += best[stage]
+        print "%-32s %8d %7d %s" % (
+            name, record_count, trip_count,
+            " ".join("%7.1fms" % (best[s] * 1000,) for s in stages))
+    print "%-32s %8s %7s %s" % (
+        "total", "", "", " ".join("%7.1fms" % (totals[s] * 1000,)
+                                  for s in stages))
+    return totals
+
+
+def run_history_benchmark(days=365, services=200, snapshots_per_day=30,
+                          query_count=1000):
+    """Time per-service statistics over a store holding days of snapshots
+
+    Each service is recorded snapshots_per_day times a day, roughly what a
+     minute-by-minute cron job sees over a service's trip.
+    """
+    rng = random.Random(0)
+    stop_ids = sorted(conf.stop_ids) or [0]
+    service_keys = [(rng.choice(stop_ids), rng.randint(0, 1439))
+                    for _ in xrange(services)]
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store = history.HistoryStore(os.path.join(tmp_dir, "history.db"),
+                                     batch_size=10000)
+        start = time.time()
+        epoch = int(time.time()) - days * 86400
+        for day in xrange(days):
+            service_date = datetime.fromtimestamp(epoch + day * 86400)
+            for n, (stop_id, start_minutes) in enumerate(service_keys):
+                for snapshot in xrange(snapshots_per_day):
+                    store.pending_rows.append((
+                        epoch + day * 86400 + snapshot * 60,
+                        service_date.date().isoformat(),
+                        service_date.weekday(), "trip-%d-%d" % (day, n),
+                        start_minutes, stop_id,
+                        conf.stop_ids.get(stop_id, "Unknown"),
+                        rng.randint(-2, 20),
+                        "Somewhere", "", history.NO_STOP_ID))
+            store.flush()
+        row_count = days * services * snapshots_per_day
+        print "Wrote %d snapshots in %.1fs" % (row_count, time.time() - start)
+
+        start = time.time()
+        for _ in xrange(query_count):
+            stop_id, start_minutes = rng.choice(service_keys)
+            store._stats_cache = {}
+            store.delay_percentiles(stop_id, start_minutes,
+                                    rng.randint(0, 6))
+        elapsed = time.time() - start
+        print "%d uncached percentile queries: %.3fs (%.2fms/query)" % \
+            (query_count, elapsed, elapsed / query_count * 1000)
+        store.close()
+        return elapsed / query_count
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def write_synthetic_gtfs(directory, lines=50, stops_per_line=40,
+                         trips_per_line=200):
+    """A GTFS stop_times.txt for a network of lines sharing some stops"""
+    rng = random.Random(0)
+    with open(os.path.join(directory, "stop_times.txt"), "w") as f:
+        f.write("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+        for line in xrange(lines):
+            stop_ids = rng.sample(xrange(1, lines * stops_per_line // 2),
+                                  stops_per_line)
+            for n in xrange(trips_per_line):
+                secs = rng.randint(4 * 3600, 25 * 3600)
+                for sequence, stop_id in enumerate(stop_ids):
+                    secs += rng.choice((120, 180, 240))
+                    hhmmss = "%02d:%02d:%02d" % (secs // 3600,
+                                                 secs % 3600 // 60, secs % 60)
+                    f.write("%d-%d,%s,%s,%d,%d\n" % (line, n, hhmmss, hhmmss,
+                                                     stop_id, sequence))
+
+
+def run_timetable_benchmark(lookup_count=100000):
+    """Time importing a synthetic GTFS timetable, loading and querying it"""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        write_synthetic_gtfs(tmp_dir)
+        matrix_path = os.path.join(tmp_dir, "transit.matrix")
+        start = time.time()
+        pair_count = timetable.import_gtfs(tmp_dir, matrix_path)
+        print "Imported %d stop pairs in %.2fs" % (pair_count,
+                                                   time.time() - start)
+
+        start = time.time()
+        matrix = timetable.TransitMatrix(matrix_path)
+        print "Loaded matrix in %.2fms" % ((time.time() - start) * 1000,)
+
+        rng = random.Random(0)
+        pairs = [(rng.randint(1, 1000), rng.randint(1, 1000))
+                 for _ in xrange(lookup_count)]
+        start = time.time()
+        found = sum(1 for from_stop_id, to_stop_id in pairs
+                    if matrix.transit_times(from_stop_id, to_stop_id))
+        elapsed = time.time() - start
+        print "%d lookups (%d found): %.3fs (%.1fus/lookup)" % \
+            (lookup_count, found, elapsed, elapsed / lookup_count * 1e6)
+        matrix.close()
+        return elapsed / lookup_count
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def time_import(module_name):
+    """{"total": secs, "timings": [(name, cumulative secs)], "modules": [...]}
+     for importing module_name in a fresh interpreter
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_TIME_SCRIPT % (module_name,)])
+    return json.loads(output.splitlines()[-1])
+
+
+def run_startup_benchmark(budget_secs=DEFAULT_STARTUP_BUDGET_SECS, repeat=5,
+                          slowest_count=8):
+    """Best of repeat import times for each entry point, against the budget
+
+    Returns the entry points that are over budget or that imported a module
+     in LAZY_MODULES.
+    """
+    failures = []
+    for module_name in STARTUP_ENTRY_POINTS:
+        results = [time_import(module_name) for _ in xrange(repeat)]
+        best = min(results, key=lambda r: r["total"])
+        eager = [m for m in LAZY_MODULES if m in best["modules"]]
+        print "%-16s %7.1fms %4d modules%s" % (
+            module_name, best["total"] * 1000, len(best["modules"]),
+            " (over budget)" if best["total"] > budget_secs else "")
+        for name, secs in sorted(best["timings"], key=lambda t: -t[1])[
+                :slowest_count]:
+            print "    %-28s %7.1fms" % (name, secs * 1000)
+        if eager:
+            print "    imported eagerly: %s" % (", ".join(eager),)
+        if eager or best["total"] > budget_secs:
+            failures.append(module_name)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--suite",
+                        choices=[SUITE_SCALING, SUITE_PIPELINE, SUITE_HISTORY,
+                                 SUITE_TIMETABLE, SUITE_STARTUP],
+                        action="append",
+                        help="Benchmark suite to run (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        help="Number of vehicle records in each synthetic feed")
+    parser.add_argument("--corpus",
+                        help="Recorded feed snapshot, or directory of them, "
+                             "for the pipeline suite")
+    parser.add_argument("--startup-budget", type=float,
+                        default=DEFAULT_STARTUP_BUDGET_SECS,
+                        help="Seconds each cron entry point may take to "
+                             "import (the startup suite fails if exceeded)")
+    parser.add_argument("--lateness_threshold_mins", type=int,
+                        default=train_notify.DEFAULT_LATENESS_THRESHOLD_MINS)
+    args = parser.parse_args()
+    suites = args.suite or [SUITE_SCALING, SUITE_PIPELINE, SUITE_HISTORY,
+                            SUITE_TIMETABLE, SUITE_STARTUP]
+
+    if SUITE_SCALING in suites:
+        run_scaling_benchmark(args.sizes or DEFAULT_FEED_SIZES)
+    if SUITE_PIPELINE in suites:
+        run_pipeline_benchmark(
+            load_corpus(args.corpus, args.sizes or DEFAULT_PIPELINE_FEED_SIZES),
+            args.lateness_threshold_mins)
+    if SUITE_HISTORY in suites:
+        run_history_benchmark()
+    if SUITE_TIMETABLE in suites:
+        run_timetable_benchmark()
+    if SUITE_STARTUP in suites:
+        if run_startup_benchmark(args.startup_budget):
+            sys.exit(1)
@@ -0,0 +1,165 @@
+"""A local stand-in for a Hue bridge, for exercising notifier offline
+
+Implements just enough of the bridge REST API for phue and
+ notifier.LightController, counts the requests it receives and can add a
+ fixed latency to each one.
+
+e.g. python fake_hue_bridge.py --port 8080 --latency 0.1
+ and set conf.HUE_BRIDGE_IP = "127.0.0.1:8080"
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import logging
+import re
+import SocketServer
+import threading
+import time
+
+__author__ = 'esteele'
+
+FAKE_USERNAME = "fakeusername"
+STATE_PATH_RE = re.compile(
+    r"^/api/(?P<username>[^/]+)/(?P<kind>lights|groups)/(?P<id>[^/]+)"
+    r"/(?:state|action)$")
+
+
+class FakeHueBridgeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Allow clients to keep the connection alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("Fake bridge: " + format, *args)
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if self.command != "PUT":
+            # phue closes its connection before reading the response, which
+            #  only works if the response says the connection will close
+            self.send_header("Connection", "close")
+            self.close_connection = 1
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.getheader("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or "{}")
+
+    def record_request(self):
+        self.server.bridge.record_request(self.command, self.path)
+
+    def do_GET(self):
+        self.record_request()
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "api":
+            self.send_json(self.server.bridge.full_state())
+        elif len(parts) == 3 and parts[2] in ("lights", "groups"):
+            self.send_json(getattr(self.server.bridge, parts[2]))
+        else:
+            self.send_json([{"error": {"type": 3, "address": self.path}}], 404)
+
+    def do_POST(self):
+        self.record_request()
+        if self.path.rstrip("/") == "/api":
+            self.read_json()
+            self.send_json([{"success": {"username": FAKE_USERNAME}}])
+        else:
+            self.send_json([{"error": {"type": 3, "address": self.path}}], 404)
+
+    def do_PUT(self):
+        self.record_request()
+        mo = STATE_PATH_RE.match(self.path)
+        state = self.read_json()
+        if mo is None:
+            self.send_json([{"error": {"type": 3, "address": self.path}}], 404)
+            return
+        self.send_json(self.server.bridge.apply_state(
+            mo.group("kind"), mo.group("id"), state))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeHueBridge(object):
+    """Fake bridge with the given light and group names
+
+    After start(), address is the "host:port" to use as the bridge IP.
+    """
+    def __init__(self, light_names=("Lamp",), group_names=(), latency=0.0,
+                 port=0):
+        self.latency = latency
+        self.lights = dict(
+            (str(n), {"name": name, "state": {"on": False, "bri": 0, "hue": 0}})
+            for n, name in enumerate(light_names, 1))
+        self.groups = dict(
+            (str(n), {"name": name, "action": {"on": False, "bri": 0,
+                                               "hue": 0}})
+            for n, name in enumerate(group_names, 1))
+        self.request_counts = collections.Counter()
+        self.state_commands = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", port),
+                                          FakeHueBridgeHandler)
+        self.server.bridge = self
+        self.address = "%s:%s" % self.server.server_address
+        self._thread = None
+
+    def record_request(self, method, path):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.request_counts[method] += 1
+
+    def full_state(self):
+        return {"lights": self.lights, "groups": self.groups, "config": {}}
+
+    def apply_state(self, kind, object_id, state):
+        objects = self.lights if kind == "lights" else self.groups
+        if object_id not in objects:
+            return [{"error": {"type": 3,
+                               "address": "/%s/%s" % (kind, object_id)}}]
+        with self._lock:
+            self.state_commands.append((kind, object_id, state))
+            key = "state" if kind == "lights" else "action"
+            objects[object_id][key].update(
+                (k, v) for k, v in state.items() if k != "transitiontime")
+        return [{"success": {"/%s/%s/%s" % (kind, object_id, k): v}}
+                for k, v in state.items()]
+
+    @property
+    def request_count(self):
+        return sum(self.request_counts.values())
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Seconds to delay each request by")
+    parser.add_argument("--light", action="append", dest="lights",
+                        help="Light name (may be repeated)")
+    parser.add_argument("--group", action="append", dest="groups",
+                        help="Group name (may be repeated)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG)
+    bridge = FakeHueBridge(args.lights or ["Lamp"], args.groups or [],
+                           args.latency, args.port)
+    print "Fake bridge listening on %s (username %s)" % (bridge.address,
+                                                         FAKE_USERNAME)
+    bridge.server.serve_forever()
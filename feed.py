@@ -0,0 +1,348 @@
+import codecs
+import hashlib
+import json
+import logging
+import re
+import time
+import metrics
+
+__author__ = 'esteele'
+
+DEFAULT_TIMEOUT_SECS = 10
+STREAM_CHUNK_SIZE = 64 * 1024
+RECORD_SECTIONS = ("delays", "vehicles", "alerts")
+
+WHITESPACE_RE = re.compile(r"[ \t\n\r]*")
+# Characters that can follow a complete JSON value
+VALUE_DELIMITERS = frozenset(",:]} \t\n\r")
+
+
+class FeedUnavailable(Exception):
+    pass
+
+
+class IncompleteInput(Exception):
+    pass
+
+
+def value_is_complete(buf, end):
+    """Whether a value decoded from buf up to end can't continue
+
+    A number that's cut off by the end of a chunk (e.g. at "12." of "12.5")
+     still decodes, so it's only complete once a delimiter follows it.
+    """
+    return end < len(buf) and buf[end] in VALUE_DELIMITERS
+
+
+class StreamingFeedParser(object):
+    """Incrementally parses the realtime feed, one record at a time
+
+    Text is passed to feed() as it arrives. Only the records in the delays,
+     vehicles and alerts lists that concern vehicles on one of routes are
+     kept, other lists are skipped record by record, and top level scalars
+     (such as the timestamp) are kept. close() returns the result in the
+     same shape as the parsed feed.
+    """
+    # Parser states
+    OBJECT_START = 0
+    KEY_OR_END = 1
+    COLON = 2
+    VALUE = 3
+    ELEMENT_OR_END = 4
+    AFTER_ELEMENT = 5
+    AFTER_VALUE = 6
+    DONE = 7
+
+    def __init__(self, routes):
+        self.routes = set(routes)
+        self.decoder = json.JSONDecoder()
+        self.buf = u""
+        self.pos = 0
+        self.state = self.OBJECT_START
+        self.key = None
+        self.result = dict((section, []) for section in RECORD_SECTIONS)
+        self.trip_ids = set()
+        self.vehicles_complete = False
+        # Delays and alerts seen before the vehicles list is complete, which
+        #  can only be filtered once we know every trip on our routes
+        self.unfiltered = dict((section, []) for section in RECORD_SECTIONS)
+        self.record_count = 0
+
+    def feed(self, text):
+        self.buf = self.buf[self.pos:] + text
+        self.pos = 0
+        try:
+            while self.state != self.DONE:
+                self._step(at_eof=False)
+        except IncompleteInput:
+            pass
+
+    def close(self):
+        try:
+            while self.state != self.DONE:
+                self._step(at_eof=True)
+        except IncompleteInput:
+            raise ValueError("Feed ended unexpectedly")
+        for section in ("delays", "alerts"):
+            self.result[section].extend(
+                r for r in self.unfiltered[section]
+                if r.get("tripId") in self.trip_ids)
+        return self.result
+
+    def _skip_whitespace(self, at_eof):
+        self.pos = WHITESPACE_RE.match(self.buf, self.pos).end()
+        if self.pos >= len(self.buf):
+            if at_eof:
+                raise ValueError("Feed ended unexpectedly")
+            raise IncompleteInput()
+        return self.buf[self.pos]
+
+    def _expect(self, char, at_eof):
+        if self._skip_whitespace(at_eof) != char:
+            raise ValueError("Expected %r at %d in feed" % (char, self.pos))
+        self.pos += 1
+
+    def _decode_value(self, at_eof):
+        self._skip_whitespace(at_eof)
+        try:
+            value, end = self.decoder.raw_decode(self.buf, self.pos)
+        except ValueError:
+            if at_eof:
+                raise
+            raise IncompleteInput()
+        if not (at_eof or value_is_complete(self.buf, end)):
+            raise IncompleteInput()
+        self.pos = end
+        return value
+
+    def _step(self, at_eof):
+        if self.state == self.OBJECT_START:
+            self._expect("{", at_eof)
+            self.state = self.KEY_OR_END
+        elif self.state == self.KEY_OR_END:
+            if self._skip_whitespace(at_eof) == "}":
+                self.pos += 1
+                self.state = self.DONE
+            else:
+                self.key = self._decode_value(at_eof)
+                self.state = self.COLON
+        elif self.state == self.COLON:
+            self._expect(":", at_eof)
+            self.state = self.VALUE
+        elif self.state == self.VALUE:
+            if self._skip_whitespace(at_eof) == "[":
+                self.pos += 1
+                self.state = self.ELEMENT_OR_END
+            else:
+                self.result[self.key] = self._decode_value(at_eof)
+                self.state = self.AFTER_VALUE
+        elif self.state in (self.ELEMENT_OR_END, self.AFTER_ELEMENT):
+            self._read_elements(at_eof)
+        elif self.state == self.AFTER_VALUE:
+            if self._skip_whitespace(at_eof) == "}":
+                self.pos += 1
+                self.state = self.DONE
+            else:
+                self._expect(",", at_eof)
+                self.state = self.KEY_OR_END
+
+    def _read_elements(self, at_eof):
+        """Read list elements until the end of the list or of the input
+
+        This is where nearly all of the feed is, so it's kept tight rather
+         than going through _step for each token.
+        """
+        buf = self.buf
+        buf_len = len(buf)
+        whitespace_match = WHITESPACE_RE.match
+        scan_once = self.decoder.scan_once
+        pos = self.pos
+        while True:
+            pos = whitespace_match(buf, pos).end()
+            if pos >= buf_len:
+                break
+            c = buf[pos]
+            if c == "]":
+                self.pos = pos + 1
+                self._end_list()
+                self.state = self.AFTER_VALUE
+                return
+            if self.state == self.AFTER_ELEMENT:
+                if c != ",":
+                    raise ValueError("Expected ',' at %d in feed" % (pos,))
+                pos += 1
+                self.state = self.ELEMENT_OR_END
+                continue
+            try:
+                record, end = scan_once(buf, pos)
+            except (StopIteration, ValueError):
+                # Incomplete, or actually invalid if there's no more input
+                break
+            if not (at_eof or value_is_complete(buf, end)):
+                break
+            self._add_record(record)
+            self.state = self.AFTER_ELEMENT
+            pos = end
+        self.pos = pos
+        if at_eof:
+            raise ValueError("Feed ended unexpectedly")
+        raise IncompleteInput()
+
+    def _end_list(self):
+        if self.key == "vehicles":
+            self.vehicles_complete = True
+
+    def _add_record(self, record):
+        self.record_count += 1
+        if self.key == "vehicles":
+            if record.get("route") in self.routes:
+                self.trip_ids.add(record["tripId"])
+                self.result["vehicles"].append(record)
+        elif self.key in ("delays", "alerts"):
+            if not self.vehicles_complete:
+                self.unfiltered[self.key].append(record)
+            elif record.get("tripId") in self.trip_ids:
+                self.result[self.key].append(record)
+        # Records in other lists aren't used
+
+
+class FeedFetcher(object):
+    """Fetches a JSON feed over a pooled connection
+
+    Conditional request headers are sent when the server has provided an
+     ETag or Last-Modified, and the body is only re-parsed when its hash
+     changes. If a fetch fails or exceeds the timeout, the last good
+     snapshot is returned instead. The timeout covers the whole request,
+     so a body that trickles in slowly doesn't hold up the run either.
+
+    With streaming, the body is parsed as it's downloaded and only records
+     for routes are kept (see StreamingFeedParser). The body text isn't
+     kept in memory, but is written to spill_path if one is given.
+    """
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT_SECS, streaming=False,
+                 routes=(), spill_path=None):
+        import requests
+        self.url = url
+        self.timeout = timeout
+        self.streaming = streaming
+        self.routes = routes
+        self.spill_path = spill_path
+        self.session = requests.Session()
+        self.etag = None
+        self.last_modified = None
+        self.body_hash = None
+        self.text = None
+        self.snapshot = None
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def fetch(self):
+        import requests
+        deadline = time.time() + self.timeout
+        try:
+            # Always streamed, so the deadline can be checked as the body
+            #  arrives
+            r = self.session.get(self.url,
+                                 headers=self.conditional_headers(),
+                                 timeout=self.timeout,
+                                 stream=True)
+            if r.status_code == 304:
+                logging.debug("Feed not modified since last fetch")
+                metrics.increment("feed_not_modified")
+                r.close()
+                return self.snapshot
+            r.raise_for_status()
+            if self.streaming:
+                body_hash, parse = self._stream(r, deadline)
+            else:
+                body = "".join(self._iter_body(r, deadline))
+                body_hash = hashlib.sha1(body).hexdigest()
+                encoding = r.encoding or "utf-8"
+                parse = lambda: json.loads(body, encoding)
+        except requests.RequestException as e:
+            metrics.increment("feed_fetch_failures")
+            if self.snapshot is None:
+                raise FeedUnavailable("Unable to fetch %s: %s" % (self.url, e))
+            logging.warning("Feed fetch failed (%s) - using last good snapshot",
+                            e)
+            return self.snapshot
+
+        if body_hash == self.body_hash:
+            logging.debug("Feed body unchanged - skipping parse")
+            metrics.increment("feed_unchanged")
+            self.etag = r.headers.get("etag")
+            self.last_modified = r.headers.get("last-modified")
+            return self.snapshot
+
+        try:
+            with metrics.timer("feed_parse"):
+                snapshot = parse()
+        except ValueError as e:
+            metrics.increment("feed_parse_failures")
+            if self.snapshot is None:
+                raise FeedUnavailable("Unparseable feed from %s: %s" %
+                                      (self.url, e))
+            logging.warning("Feed parse failed (%s) - using last good snapshot",
+                            e)
+            return self.snapshot
+
+        # Only validators for a body that parsed, so a bad body isn't
+        #  answered with 304 until the feed changes
+        self.etag = r.headers.get("etag")
+        self.last_modified = r.headers.get("last-modified")
+        self.body_hash = body_hash
+        if not self.streaming:
+            self.text = body.decode(encoding)
+        self.snapshot = snapshot
+        return self.snapshot
+
+    def _iter_body(self, r, deadline):
+        """r's body in chunks, raising requests.Timeout past deadline"""
+        import requests
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+            if time.time() > deadline:
+                r.close()
+                metrics.increment("feed_fetch_timeouts")
+                raise requests.Timeout("Feed took more than %ss to download"
+                                       % (self.timeout,))
+            yield chunk
+
+    def _stream(self, r, deadline):
+        """Parse r's body as it arrives. Returns (body hash, result getter)"""
+        parser = StreamingFeedParser(self.routes)
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")()
+        body_hash = hashlib.sha1()
+        spill = open(self.spill_path, "wb") if self.spill_path else None
+        parse_error = None
+        try:
+            for chunk in self._iter_body(r, deadline):
+                body_hash.update(chunk)
+                if spill:
+                    spill.write(chunk)
+                if parse_error is None:
+                    try:
+                        parser.feed(decoder.decode(chunk))
+                    except ValueError as e:
+                        # Keep reading so the hash and spill file are whole
+                        parse_error = e
+        finally:
+            if spill:
+                spill.close()
+
+        def parse():
+            if parse_error is not None:
+                raise parse_error
+            parser.feed(decoder.decode("", final=True))
+            result = parser.close()
+            metrics.increment("feed_records_streamed", parser.record_count)
+            logging.debug("Kept %d of %d feed records",
+                          sum(len(result[s]) for s in RECORD_SECTIONS),
+                          parser.record_count)
+            return result
+        return body_hash.hexdigest(), parse
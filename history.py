@@ -0,0 +1,168 @@
+"""Append-only store of trip delay snapshots, with per-service statistics"""
+from datetime import datetime, timedelta
+import logging
+import sqlite3
+
+__author__ = 'esteele'
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_PERCENTILES = (50, 90)
+# Stands in for the boarding stop of trips whose transit times are looked up
+#  by origin stop name rather than in the transit matrix
+NO_STOP_ID = -1
+
+TABLE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS delay_snapshots (
+    recorded_at INTEGER NOT NULL,
+    service_date TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    trip_id TEXT NOT NULL,
+    start_minutes INTEGER NOT NULL,
+    start_loc_int INTEGER NOT NULL,
+    start_loc_str TEXT NOT NULL,
+    delay_mins INTEGER NOT NULL,
+    location TEXT,
+    offsets TEXT,
+    boarding_stop_id INTEGER NOT NULL DEFAULT -1
+);
+"""
+# Stores created before delays were kept per boarding stop
+BOARDING_STOP_MIGRATION = """
+ALTER TABLE delay_snapshots
+    ADD COLUMN boarding_stop_id INTEGER NOT NULL DEFAULT -1;
+"""
+INDEX_SCHEMA = """
+-- Covers the statistics queries, so they never touch the table itself.
+--  Services are keyed by origin stop id, as stop names needn't be unique,
+--  and delays are estimated at a boarding stop
+DROP INDEX IF EXISTS delay_snapshots_by_service;
+DROP INDEX IF EXISTS delay_snapshots_by_origin;
+CREATE INDEX IF NOT EXISTS delay_snapshots_by_boarding_stop
+    ON delay_snapshots (start_loc_int, start_minutes, boarding_stop_id,
+                        weekday, service_date, delay_mins);
+"""
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile p (0-100) of a non-empty sorted list"""
+    rank = max(1, int(round(p / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def minutes_since_midnight(td):
+    return td.days * 1440 + td.seconds // 60
+
+
+def boarding_stop_id(trip):
+    if trip.boarding_stop_id is None:
+        return NO_STOP_ID
+    return trip.boarding_stop_id
+
+
+class HistoryStore(object):
+    """Delay snapshots of trips, kept in sqlite
+
+    Snapshots are buffered and written in batches of batch_size, or when
+     flush() is called. A service is identified by its origin stop and
+     scheduled start time, and its statistics use the worst delay recorded
+     on each day it ran. Delays are estimated at a boarding stop, so they're
+     kept and looked up per boarding stop.
+    """
+    # So callers can catch the store's errors without importing sqlite3
+    Error = sqlite3.Error
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(TABLE_SCHEMA)
+        columns = [row[1] for row in
+                   self.connection.execute("PRAGMA table_info(delay_snapshots)")]
+        if "boarding_stop_id" not in columns:
+            self.connection.executescript(BOARDING_STOP_MIGRATION)
+        self.connection.executescript(INDEX_SCHEMA)
+        self.pending_rows = []
+        self._stats_cache = {}
+
+    def record(self, trips, timestamp):
+        """Buffer a snapshot of each trip, as retrieved at unix timestamp"""
+        retrieved = datetime.fromtimestamp(timestamp)
+        service_date = retrieved.date().isoformat()
+        weekday = retrieved.weekday()
+        for t in trips:
+            if t.start_loc_int < 0 or \
+                    t.est_scheduled_arrival_earliest == timedelta.max:
+                # No delay data, or no arrival at the boarding stop to
+                #  estimate the delay at, so nothing worth keeping
+                continue
+            self.pending_rows.append((
+                int(timestamp), service_date, weekday, t.trip_id,
+                minutes_since_midnight(t.start_time_timedelta),
+                t.start_loc_int, t.start_loc_str,
+                t.estimate_delay_at_boarding_station(), t.location,
+                t.offsets.to_string(), boarding_stop_id(t)))
+        if len(self.pending_rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO delay_snapshots (recorded_at, service_date, "
+                "weekday, trip_id, start_minutes, start_loc_int, "
+                "start_loc_str, delay_mins, location, offsets, "
+                "boarding_stop_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self.pending_rows)
+        logging.debug("Recorded %d delay snapshots", len(self.pending_rows))
+        self.pending_rows = []
+        self._stats_cache = {}
+
+    def daily_delays(self, start_loc_int, start_minutes, weekday=None,
+                     boarding_stop_id=NO_STOP_ID):
+        """Worst delay on each day the service ran, in ascending order"""
+        query = "SELECT MAX(delay_mins) AS d FROM delay_snapshots " \
+                "WHERE start_loc_int = ? AND start_minutes = ? " \
+                "AND boarding_stop_id = ?"
+        params = [start_loc_int, start_minutes, boarding_stop_id]
+        if weekday is not None:
+            query += " AND weekday = ?"
+            params.append(weekday)
+        query += " GROUP BY service_date ORDER BY d"
+        return [row[0] for row in self.connection.execute(query, params)]
+
+    def delay_percentiles(self, start_loc_int, start_minutes, weekday=None,
+                          percentiles=DEFAULT_PERCENTILES,
+                          boarding_stop_id=NO_STOP_ID):
+        """{percentile: delay in minutes} for the service, or None if unknown
+
+        start_loc_int is the origin stop id, start_minutes is the scheduled
+         start as minutes since midnight, weekday (0 is Monday) restricts
+         the statistics to that day of the week, and boarding_stop_id is the
+         stop the delays were estimated at.
+        """
+        key = (start_loc_int, start_minutes, weekday, tuple(percentiles),
+               boarding_stop_id)
+        if key not in self._stats_cache:
+            delays = self.daily_delays(start_loc_int, start_minutes, weekday,
+                                       boarding_stop_id)
+            if delays:
+                self._stats_cache[key] = dict(
+                    (p, percentile(delays, p)) for p in percentiles)
+            else:
+                self._stats_cache[key] = None
+        return self._stats_cache[key]
+
+    def usual_delay(self, trip, weekday):
+        """Median worst delay for the trip's service on weekday, or None"""
+        if trip.start_loc_int < 0:
+            return None
+        stats = self.delay_percentiles(
+            trip.start_loc_int,
+            minutes_since_midnight(trip.start_time_timedelta), weekday, (50,),
+            boarding_stop_id(trip))
+        return stats[50] if stats else None
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -1,116 +1,675 @@
+import argparse
+import errno
+import json
 import logging
-import threading
+import os
+import select
+import socket
+import tempfile
 import time
 
 __author__ = 'esteele'
 import conf
+import metrics
 import re
-import subprocess32 as subprocess
-import multiprocessing
 
 
-class ContactingThread(threading.Thread):
-    NOT_FOUND = "not found"
+NOT_FOUND = "not found"
+# iOS devices listen on this port (lockdownd) whenever they're on the network
+DEFAULT_TCP_PROBE_PORT = 62078
+DEFAULT_UDP_PROBE_PORT = 7
+DEFAULT_PROBE_TYPES = ("tcp", "ping")
+# How long a probe with a fallback gets before the fallback is started. A
+#  host on the LAN answers a TCP connect (even to refuse it) in
+#  milliseconds, but a firewalled port never answers at all
+DEFAULT_FALLBACK_PROBE_TIMEOUT_SECS = 1
+PROC_NET_ARP_PATH = "/proc/net/arp"
+DEFAULT_NEIGHBOR_POLL_SECS = 5
+# Complete entry flag in /proc/net/arp
+ATF_COM = 0x2
+NEIGHBOR_REACHABLE = "reachable"
+NEIGHBOR_STALE = "stale"
+NEIGHBOR_FAILED = "failed"
+DEFAULT_LOCATION_CACHE_PATH = os.path.join(tempfile.gettempdir(),
+                                           "notifications-location.json")
+DEFAULT_LOCATION_CACHE_TTL_SECS = 60
+# Consecutive observations needed to confirm the device was found somewhere
+#  new, or has gone
+DEFAULT_FOUND_CONFIRMATIONS = 1
+DEFAULT_LOST_CONFIRMATIONS = 3
+# Less than the cache TTL, so the cache stays fresh while nothing changes
+DEFAULT_MAX_POLL_SECS = 45
+POLL_BACKOFF_FACTOR = 2
 
-    def __init__(self, ip_address, location_name, ping_count):
+
+class Probe(object):
+    """A non-blocking check of whether a host is contactable
+
+    Subclasses provide:
+     start() begins the check, and returns True if the host was found
+      straight away, False if the probe failed, or None if it's waiting.
+     fileno() is the descriptor to wait on. The engine waits until it's
+      readable, or writable if wants_write is set.
+     check() is called once the descriptor is ready, and returns True,
+      False or None as for start().
+     cancel() releases any resources, and may be called more than once.
+    """
+    wants_write = False
+
+    def __init__(self, ip_address, ping_period):
         self.ip_address = ip_address
-        self.location_name = location_name
-        self.ping_count = ping_count
-        self.result = self.NOT_FOUND
-        super(ContactingThread, self).__init__()
+        self.ping_period = ping_period
+
+    def cancel(self):
+        pass
+
+
+class SocketProbe(Probe):
+    # A refused connection still means the host answered
+    CONTACTED_ERRNOS = (0, errno.ECONNREFUSED)
+
+    def __init__(self, ip_address, ping_period, port):
+        super(SocketProbe, self).__init__(ip_address, ping_period)
+        self.port = port
+        self.sock = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def cancel(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class TcpConnectProbe(SocketProbe):
+    wants_write = True
+
+    def __init__(self, ip_address, ping_period,
+                 port=DEFAULT_TCP_PROBE_PORT):
+        super(TcpConnectProbe, self).__init__(ip_address, ping_period, port)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((self.ip_address, self.port))
+        if err in self.CONTACTED_ERRNOS:
+            return True
+        if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+            return False
+        return None
 
-    def run(self):
+    def check(self):
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        return err in self.CONTACTED_ERRNOS
+
+
+class UdpEchoProbe(SocketProbe):
+    def __init__(self, ip_address, ping_period,
+                 port=DEFAULT_UDP_PROBE_PORT):
+        super(UdpEchoProbe, self).__init__(ip_address, ping_period, port)
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
         try:
-            # Redirect stderr - we don't want spammage if the host is
-            #  uncontactable
-            output = subprocess.check_output(
-                ["/sbin/ping", "-c", str(self.ping_count), "-o", self.ip_address],
-                stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            # Unable to ping, possibly because there's no route or
-            #  because it can't resolve the address
-            output = ""
-
-        mo = re.search("(?P<recv_count>[0-9]+) packets received", output)
-        if mo:
-            recv_count = int(mo.group("recv_count"))
-            if recv_count > 0:
-                self.result = self.location_name
-
-
-def locate(host_tuples, ping_period):
-    """Each host tuple is (ip_address, location name)"""
-    thread_list = []
-    for ip, loc_name in host_tuples:
-        t = ContactingThread(ip, loc_name, ping_period)
-        thread_list.append(t)
-        # So we don't need to wait for all to finish. There aren't any
-        #  sensitive resources in use by the thread, so abrupt termination
-        #  isn't a problem.
-        t.daemon = True
-        t.start()
-
-    # first thread to complete with a value other than NOT_FOUND is the one
-    #  that has most current location information, so that's the one we care
-    #  about.
-    # There'll always be a main thread, so we look for active_count > 1
-    location = ContactingThread.NOT_FOUND
-    while threading.active_count() > 1 and \
-            location == ContactingThread.NOT_FOUND:
-        for t in thread_list:
-            t.join(timeout=1.0)
-            if not t.is_alive():
-                # Thread just came back with location information
-                logging.debug("Thread %s (looking for %s) provided location %s",
-                              t, t.ip_address, t.result)
-                location = t.result
-
-    logging.info("Location is %s", location)
+            # Connected so that ICMP port unreachable is reported to us
+            self.sock.connect((self.ip_address, self.port))
+            self.sock.send("locator")
+        except socket.error:
+            return False
+        return None
+
+    def check(self):
+        try:
+            self.sock.recv(1024)
+        except socket.error as e:
+            return e.errno in self.CONTACTED_ERRNOS
+        return True
+
+
+class PingProbe(Probe):
+    def __init__(self, ip_address, ping_period):
+        super(PingProbe, self).__init__(ip_address, ping_period)
+        self.process = None
+        self.output = []
+
+    def start(self):
+        import subprocess32 as subprocess
+        # Redirect stderr - we don't want spammage if the host is
+        #  uncontactable
+        self.process = subprocess.Popen(
+            ["/sbin/ping", "-c", str(self.ping_period), "-o", self.ip_address],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return None
+
+    def fileno(self):
+        return self.process.stdout.fileno()
+
+    def check(self):
+        chunk = os.read(self.fileno(), 4096)
+        if chunk:
+            self.output.append(chunk)
+            return None
+        # EOF, so ping has finished
+        self.process.wait()
+        self.process.stdout.close()
+        mo = re.search("(?P<recv_count>[0-9]+) packets received",
+                       "".join(self.output))
+        return bool(mo and int(mo.group("recv_count")) > 0)
+
+    def cancel(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except OSError:
+                # Already exited
+                pass
+            self.process.wait()
+            self.process.stdout.close()
+
+
+def make_probe(probe_type, ip_address, ping_period):
+    if probe_type == "tcp":
+        return TcpConnectProbe(
+            ip_address, ping_period,
+            getattr(conf, "TCP_PROBE_PORT", DEFAULT_TCP_PROBE_PORT))
+    elif probe_type == "udp":
+        return UdpEchoProbe(
+            ip_address, ping_period,
+            getattr(conf, "UDP_PROBE_PORT", DEFAULT_UDP_PROBE_PORT))
+    elif probe_type == "ping":
+        return PingProbe(ip_address, ping_period)
+    raise ValueError("Unknown probe type %s" % (probe_type,))
+
+
+@metrics.timed("probe_hosts")
+def locate(host_tuples, ping_period, probe_types=None):
+    """Each host tuple is (ip_address, location name)
+
+    All hosts are probed concurrently from a single select loop. For each
+     host the probe types are tried in order, with later types only started
+     once the earlier ones fail or time out, so ping is a fallback for
+     hosts that don't answer a TCP connect. A probe with a fallback gets
+     conf.FALLBACK_PROBE_TIMEOUT_SECS, and a host's last probe gets the
+     whole ping period. The first host found gives the location and all
+     other probes are cancelled straight away.
+    """
+    if probe_types is None:
+        probe_types = getattr(conf, "LOCATION_PROBES", DEFAULT_PROBE_TYPES)
+    fallback_timeout = getattr(conf, "FALLBACK_PROBE_TIMEOUT_SECS",
+                               DEFAULT_FALLBACK_PROBE_TIMEOUT_SECS)
+    # Probe types still to try for each host, in order
+    pending_types = dict((ip, list(probe_types)) for ip, _ in host_tuples)
+    location_names = dict(host_tuples)
+    active = []
+    deadlines = {}
+    location = NOT_FOUND
+
+    def start_next_probe(ip):
+        while pending_types[ip]:
+            probe = make_probe(pending_types[ip].pop(0), ip, ping_period)
+            if pending_types[ip]:
+                deadlines[probe] = time.time() + fallback_timeout
+            else:
+                # Allow the last ping a moment to report before giving up
+                deadlines[probe] = time.time() + ping_period + 1
+            metrics.increment("probes_started")
+            try:
+                found = probe.start()
+            except (socket.error, OSError) as e:
+                logging.debug("Unable to start %s for %s: %s",
+                              probe.__class__.__name__, ip, e)
+                metrics.increment("probe_start_failures")
+                found = False
+            if found is None:
+                active.append(probe)
+                return None
+            probe.cancel()
+            if found:
+                return probe
+        return None
+
+    try:
+        for ip, _ in host_tuples:
+            probe = start_next_probe(ip)
+            if probe is not None:
+                location = location_names[probe.ip_address]
+                return location
+
+        while active:
+            now = time.time()
+            for probe in [p for p in active if deadlines[p] <= now]:
+                logging.debug("%s for %s timed out",
+                              probe.__class__.__name__, probe.ip_address)
+                active.remove(probe)
+                probe.cancel()
+                metrics.increment("probes_timed_out")
+                probe = start_next_probe(probe.ip_address)
+                if probe is not None:
+                    location = location_names[probe.ip_address]
+                    return location
+            if not active:
+                break
+            readers = [p for p in active if not p.wants_write]
+            writers = [p for p in active if p.wants_write]
+            remaining = min(deadlines[p] for p in active) - time.time()
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  max(0, remaining))
+            for probe in readable + writable:
+                found = probe.check()
+                if found is None:
+                    continue
+                active.remove(probe)
+                probe.cancel()
+                if found:
+                    logging.debug("%s (looking for %s) provided location %s",
+                                  probe.__class__.__name__, probe.ip_address,
+                                  location_names[probe.ip_address])
+                    location = location_names[probe.ip_address]
+                    return location
+                # Fall back to the host's next probe type, if any
+                probe = start_next_probe(probe.ip_address)
+                if probe is not None:
+                    location = location_names[probe.ip_address]
+                    return location
+    finally:
+        for probe in active:
+            probe.cancel()
+        metrics.increment("probes_cancelled", len(active))
+        logging.info("Location is %s", location)
+    return location
+
+
+def location_cache_path():
+    return getattr(conf, "LOCATION_CACHE_FILE", DEFAULT_LOCATION_CACHE_PATH)
+
+
+def write_cached_location(location, path=None):
+    """Record location as current, for readers of read_cached_location
+
+    The file is replaced atomically so readers never see a partial write.
+    """
+    path = path or location_cache_path()
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump({"location": location, "checked_at": time.time()}, f)
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_cached_location(ttl, path=None):
+    """Cached location if it was checked within ttl seconds, otherwise None
+
+    A missing or malformed cache is treated as out of date.
+    """
+    path = path or location_cache_path()
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+        location = cached["location"]
+        age = time.time() - cached["checked_at"]
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        logging.debug("Location cache %s unusable: %r", path, e)
+        return None
+    if not 0 <= age <= ttl:
+        return None
+    logging.debug("Using cached location %s (%.1f secs old)", location, age)
+    return location
+
+
+def cache_location(location, path=None):
+    """write_cached_location, logging rather than raising if it can't be
+     written
+
+    The location is still good, it just won't be reused.
+    """
+    try:
+        write_cached_location(location, path)
+    except EnvironmentError as e:
+        logging.warning("Unable to cache location in %s: %s",
+                        path or location_cache_path(), e)
+
+
+def cached_locate(host_tuples, ping_period, ttl=None, path=None):
+    """As locate, but reusing a location checked within the last ttl secs
+
+    report_location_changes keeps the cache fresh when it's running, so
+     this usually avoids probing altogether.
+    """
+    if ttl is None:
+        ttl = getattr(conf, "LOCATION_CACHE_TTL_SECS",
+                      DEFAULT_LOCATION_CACHE_TTL_SECS)
+    location = read_cached_location(ttl, path)
+    if location is None:
+        metrics.increment("location_cache_misses")
+        location = locate(host_tuples, ping_period)
+        cache_location(location, path)
+    else:
+        metrics.increment("location_cache_hits")
     return location
 
 
-def report_location_changes(host_tuples, ping_period):
-    last_location = locate(host_tuples, ping_period)
+def parse_proc_net_arp(text):
+    """{ip: neighbor state} from the contents of /proc/net/arp
+
+    /proc/net/arp doesn't expose the kernel's reachability state, only
+     whether the entry is complete, so complete entries are treated as
+     reachable and incomplete ones as failed.
+    """
+    table = {}
+    for line in text.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        ip, flags = fields[0], int(fields[2], 16)
+        if flags & ATF_COM:
+            table[ip] = NEIGHBOR_REACHABLE
+        else:
+            table[ip] = NEIGHBOR_FAILED
+    return table
+
+
+def parse_ip_neigh(text):
+    """{ip: neighbor state} from the output of `ip neigh show`
+
+    e.g. "192.168.1.20 dev wlan0 lladdr 00:11:22:33:44:55 STALE"
+    """
+    table = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        nud_state = fields[-1]
+        if nud_state in ("REACHABLE", "PERMANENT", "NOARP"):
+            table[fields[0]] = NEIGHBOR_REACHABLE
+        elif nud_state in ("STALE", "DELAY", "PROBE"):
+            # The kernel hasn't heard from the host lately
+            table[fields[0]] = NEIGHBOR_STALE
+        else:
+            table[fields[0]] = NEIGHBOR_FAILED
+    return table
+
+
+def read_neighbor_table(path=None):
+    """{ip: neighbor state} for every host in the kernel neighbor table
+
+    With no path, `ip neigh show` is used as it reports stale entries,
+     falling back to /proc/net/arp where the ip command isn't available.
+     A path is read as a saved copy of either format.
+    """
+    if path is None:
+        import subprocess32 as subprocess
+        try:
+            return parse_ip_neigh(
+                subprocess.check_output(["ip", "neigh", "show"]))
+        except (OSError, subprocess.CalledProcessError):
+            path = PROC_NET_ARP_PATH
+    with open(path) as f:
+        text = f.read()
+    if text.startswith("IP address"):
+        return parse_proc_net_arp(text)
+    return parse_ip_neigh(text)
+
+
+def passive_locate(host_tuples, ping_period, neighbor_table):
+    """Location from the neighbor table, probing only stale or unknown hosts"""
+    for ip, loc_name in host_tuples:
+        if neighbor_table.get(ip) == NEIGHBOR_REACHABLE:
+            logging.debug("Neighbor table has %s (%s) reachable",
+                          ip, loc_name)
+            return loc_name
+    stale_host_tuples = [(ip, loc_name) for ip, loc_name in host_tuples
+                         if neighbor_table.get(ip, NEIGHBOR_STALE) ==
+                         NEIGHBOR_STALE]
+    if stale_host_tuples:
+        logging.debug("Actively probing stale neighbors %s",
+                      stale_host_tuples)
+        return locate(stale_host_tuples, ping_period)
+    return NOT_FOUND
+
+
+class PassiveObserver(object):
+    """Observes the location from the neighbor table
+
+    The location is only re-evaluated when the entries for our hosts
+     change, or when one of them is stale, so most observations cost no
+     network traffic.
+    """
+    def __init__(self, host_tuples, ping_period, neighbor_table_path=None):
+        self.host_tuples = host_tuples
+        self.ping_period = ping_period
+        self.neighbor_table_path = neighbor_table_path
+        self.ips = [ip for ip, _ in host_tuples]
+        self.last_states = None
+        self.last_location = NOT_FOUND
+
+    def __call__(self):
+        neighbor_table = read_neighbor_table(self.neighbor_table_path)
+        states = [neighbor_table.get(ip) for ip in self.ips]
+        if states != self.last_states or NEIGHBOR_STALE in states:
+            self.last_states = states
+            self.last_location = passive_locate(
+                self.host_tuples, self.ping_period, neighbor_table)
+        return self.last_location
+
+
+class LocationChange(object):
+    """The device's confirmed location changed from previous to current"""
+    def __init__(self, previous, current, changed_at):
+        self.previous = previous
+        self.current = current
+        self.changed_at = changed_at
+
+    def describe(self):
+        return describe_location_change(self.previous, self.current)
+
+    def __repr__(self):
+        return "<LocationChange %s -> %s>" % (self.previous, self.current)
+
+
+class LocationDebouncer(object):
+    """Confirms a change of location once it's been seen repeatedly
+
+    A single failed probe round is common even when the device hasn't
+     moved, so it's only taken to be gone after lost_confirmations
+     consecutive observations of NOT_FOUND. Finding it somewhere is rarely
+     wrong, so a move needs only found_confirmations.
+    """
+    def __init__(self, location,
+                 found_confirmations=DEFAULT_FOUND_CONFIRMATIONS,
+                 lost_confirmations=DEFAULT_LOST_CONFIRMATIONS):
+        self.location = location
+        self.found_confirmations = found_confirmations
+        self.lost_confirmations = lost_confirmations
+        self.candidate = None
+        self.candidate_count = 0
+
+    @property
+    def pending(self):
+        """Whether a change has been seen but not yet confirmed"""
+        return self.candidate is not None
+
+    def observe(self, location, now=None):
+        """Returns a LocationChange if location confirms one, else None"""
+        if location == self.location:
+            if self.candidate is not None:
+                logging.debug("Ignoring brief change of location to %s",
+                              self.candidate)
+                metrics.increment("location_flaps_suppressed")
+                self.candidate = None
+            return None
+        if location != self.candidate:
+            self.candidate = location
+            self.candidate_count = 0
+        self.candidate_count += 1
+        if location == NOT_FOUND:
+            needed = self.lost_confirmations
+        else:
+            needed = self.found_confirmations
+        if self.candidate_count < needed:
+            return None
+        change = LocationChange(self.location, location,
+                                now if now is not None else time.time())
+        self.location = location
+        self.candidate = None
+        return change
+
+
+class AdaptiveInterval(object):
+    """A poll interval that backs off while nothing changes"""
+    def __init__(self, min_secs, max_secs, factor=POLL_BACKOFF_FACTOR):
+        self.min_secs = min_secs
+        self.max_secs = max(min_secs, max_secs)
+        self.factor = factor
+        self.secs = min_secs
+
+    def tighten(self):
+        self.secs = self.min_secs
+
+    def back_off(self):
+        self.secs = min(self.secs * self.factor, self.max_secs)
+
+
+def location_changes(observe, min_interval, max_interval=None,
+                     found_confirmations=DEFAULT_FOUND_CONFIRMATIONS,
+                     lost_confirmations=DEFAULT_LOST_CONFIRMATIONS,
+                     location_observed=None):
+    """Yields a LocationChange whenever observe()'s location changes
+
+    Changes are debounced with LocationDebouncer. observe() is called every
+     min_interval seconds after a change, or while one is being confirmed,
+     backing off to every max_interval seconds while the location is
+     stable. If given, location_observed is called with the confirmed
+     location after every observation.
+    """
+    if max_interval is None:
+        max_interval = getattr(conf, "LOCATION_MAX_POLL_SECS",
+                               DEFAULT_MAX_POLL_SECS)
+    check_start = time.time()
+    debouncer = LocationDebouncer(observe(), found_confirmations,
+                                  lost_confirmations)
+    interval = AdaptiveInterval(min_interval, max_interval)
+    logging.info("Location is %s", debouncer.location)
+    if location_observed:
+        location_observed(debouncer.location)
     while True:
-        last_check_finish = time.time()
-        current_location = locate(host_tuples, ping_period)
-        current_check_duration = time.time() - last_check_finish
-        if current_check_duration < conf.LOCATION_PING_PERIOD_SECS:
-            # Finished too quick. Chances are the ping is failing fast and we
-            #  should just throttle ourselves and wait before trying again.
-            throttle_period_secs = \
-                conf.LOCATION_PING_PERIOD_SECS - current_check_duration
-            logging.debug("Ping completed quickly - throttling for %.1f secs",
-                          throttle_period_secs)
-            time.sleep(throttle_period_secs)
-
-        location_msg = ""
-        if last_location != ContactingThread.NOT_FOUND:
-            location_msg += "Device was located in %s " % (last_location,)
-            if last_location == current_location:
-                location_msg += "and is still there"
-            else:
-                if last_location != ContactingThread.NOT_FOUND:
-                    location_msg += "but became inaccessible"
-                else:
-                    location_msg += "but moved to %s" % (current_location,)
+        # Time spent observing counts towards the interval, so a probe
+        #  round that fails fast doesn't make us poll faster
+        time.sleep(max(0, interval.secs - (time.time() - check_start)))
+        check_start = time.time()
+        change = debouncer.observe(observe(), check_start)
+        if location_observed:
+            location_observed(debouncer.location)
+        if change is not None or debouncer.pending:
+            interval.tighten()
+        else:
+            interval.back_off()
+        logging.debug("Next location check in %.1f secs", interval.secs)
+        if change is not None:
+            metrics.increment("location_changes")
+            yield change
+
+
+def active_location_changes(host_tuples, ping_period, min_interval=None,
+                            max_interval=None, location_observed=None):
+    """location_changes, probing the hosts with locate()"""
+    if min_interval is None:
+        min_interval = getattr(conf, "LOCATION_MIN_POLL_SECS", ping_period)
+    return location_changes(lambda: locate(host_tuples, ping_period),
+                            min_interval, max_interval,
+                            location_observed=location_observed)
+
+
+def passive_location_changes(host_tuples, ping_period,
+                             neighbor_table_path=None,
+                             poll_period=DEFAULT_NEIGHBOR_POLL_SECS,
+                             max_poll_period=None, location_observed=None):
+    """location_changes, watching the neighbor table with PassiveObserver
+
+    Reading the neighbor table costs no network traffic, so by default it
+     keeps being polled every poll_period rather than backing off.
+    """
+    if max_poll_period is None:
+        max_poll_period = poll_period
+    return location_changes(
+        PassiveObserver(host_tuples, ping_period, neighbor_table_path),
+        poll_period, max_poll_period, location_observed=location_observed)
+
+
+def describe_location_change(last_location, current_location):
+    location_msg = ""
+    if last_location != NOT_FOUND:
+        location_msg += "Device was located in %s " % (last_location,)
+        if last_location == current_location:
+            location_msg += "and is still there"
         else:
-            location_msg += "Device was inaccessible "
-            if current_location != ContactingThread.NOT_FOUND:
-                location_msg += "but is now located in %s" % (current_location,)
+            if current_location == NOT_FOUND:
+                location_msg += "but became inaccessible"
             else:
-                location_msg += "and is still inaccessible"
+                location_msg += "but moved to %s" % (current_location,)
+    else:
+        location_msg += "Device was inaccessible "
+        if current_location != NOT_FOUND:
+            location_msg += "but is now located in %s" % (current_location,)
+        else:
+            location_msg += "and is still inaccessible"
+    return location_msg
+
+
+def log_location_change(change):
+    logging.info(change.describe())
+
+
+def dispatch_location_changes(changes, subscribers):
+    """Call each subscriber with each LocationChange from changes
 
-        logging.info(location_msg)
-        last_location = current_location
+    A failing subscriber is logged and doesn't stop the others, or later
+     changes, from being dispatched.
+    """
+    for change in changes:
+        for subscriber in subscribers:
+            try:
+                subscriber(change)
+            except Exception:
+                logging.exception("Location change subscriber %s failed",
+                                  getattr(subscriber, "__name__", subscriber))
 
 
+def report_location_changes(host_tuples, ping_period, passive=False,
+                            neighbor_table_path=None, subscribers=()):
+    """Log location changes and pass them to subscribers, keeping the
+     location cache up to date
 
+    Every check refreshes the cache, so a change is visible to
+     cached_locate as soon as it's confirmed.
+    """
+    if passive:
+        changes = passive_location_changes(
+            host_tuples, ping_period, neighbor_table_path,
+            location_observed=cache_location)
+    else:
+        changes = active_location_changes(
+            host_tuples, ping_period, location_observed=cache_location)
+    dispatch_location_changes(changes,
+                              [log_location_change] + list(subscribers))
 
 
 if __name__ == "__main__":
     # print is_contactable("localhost", 2)
     # print locate(conf.ADDRESS_NAME_PAIR_LISTS, conf.LOCATION_PING_PERIOD_SECS)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--passive", action="store_true", default=False,
+                        help="Watch the kernel neighbor table, only probing "
+                             "when our hosts' entries are stale")
+    parser.add_argument("--neighbor-table",
+                        help="Neighbor table file in /proc/net/arp or "
+                             "`ip neigh` format")
+    args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
     report_location_changes(
-        conf.ADDRESS_NAME_PAIR_LISTS, conf.LOCATION_PING_PERIOD_SECS)
+        conf.ADDRESS_NAME_PAIR_LISTS, conf.LOCATION_PING_PERIOD_SECS,
+        passive=args.passive, neighbor_table_path=args.neighbor_table)
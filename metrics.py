@@ -0,0 +1,158 @@
+"""Stage timings, counters and failures, for finding out what made a run slow
+
+Stages are timed with the timer() context manager or the timed() decorator,
+ which also count the stage's failures (exceptions raised out of it), and
+ events are counted with increment(). Everything is kept in a process-wide
+ Registry that can be written out as a Prometheus text file (e.g. for
+ node_exporter's textfile collector) or appended to a JSON lines file.
+"""
+from contextlib import contextmanager
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+
+__author__ = 'esteele'
+
+METRIC_PREFIX = "train_notify_"
+FORMAT_PROMETHEUS = "prometheus"
+FORMAT_JSON = "json"
+
+
+class Registry(object):
+    """Counters, and the count, total, max and last duration of each stage"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+            self.failures = {}
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_duration(self, stage, seconds):
+        with self._lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                self.timings[stage] = {"count": 1, "total": seconds,
+                                       "max": seconds, "last": seconds}
+            else:
+                timing["count"] += 1
+                timing["total"] += seconds
+                timing["max"] = max(timing["max"], seconds)
+                timing["last"] = seconds
+
+    def record_failure(self, stage):
+        with self._lock:
+            self.failures[stage] = self.failures.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.record_failure(stage)
+            raise
+        finally:
+            self.record_duration(stage, time.time() - start)
+
+    def timed(self, stage):
+        """Decorator timing each call of the function as stage"""
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self._lock:
+            return {"counters": dict(self.counters),
+                    "timings": dict((stage, dict(timing)) for stage, timing
+                                    in self.timings.items()),
+                    "failures": dict(self.failures)}
+
+    def prometheus_text(self, prefix=METRIC_PREFIX):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, samples):
+            """samples are (sample name suffix, stage or None, value)"""
+            lines.append("# TYPE %s%s %s" % (prefix, name, kind))
+            for suffix, stage, value in samples:
+                labels = '{stage="%s"}' % (stage,) if stage else ""
+                lines.append("%s%s%s%s %r" % (prefix, name, suffix, labels,
+                                              value))
+
+        for name, value in sorted(snapshot["counters"].items()):
+            metric("%s_total" % (name,), "counter", [("", None, value)])
+        timings = sorted(snapshot["timings"].items())
+        if timings:
+            metric("stage_duration_seconds", "summary",
+                   [("_sum", stage, timing["total"])
+                    for stage, timing in timings] +
+                   [("_count", stage, timing["count"])
+                    for stage, timing in timings])
+            metric("stage_last_duration_seconds", "gauge",
+                   [("", stage, timing["last"]) for stage, timing in timings])
+            metric("stage_max_duration_seconds", "gauge",
+                   [("", stage, timing["max"]) for stage, timing in timings])
+        failures = sorted(snapshot["failures"].items())
+        if failures:
+            metric("stage_failures_total", "counter",
+                   [("", stage, count) for stage, count in failures])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Replace path with the metrics, atomically so scrapers never see a
+         partial file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.prometheus_text())
+        os.rename(tmp_path, path)
+
+    def append_json_line(self, path):
+        snapshot = self.snapshot()
+        snapshot["timestamp"] = time.time()
+        with open(path, "a") as f:
+            f.write(json.dumps(snapshot, sort_keys=True) + "\n")
+
+    def write(self, path, format=FORMAT_PROMETHEUS):
+        if format == FORMAT_JSON:
+            self.append_json_line(path)
+        else:
+            self.write_prometheus(path)
+
+
+_registry = Registry()
+
+
+def get_registry():
+    """The process-wide Registry"""
+    return _registry
+
+
+def increment(name, n=1):
+    _registry.increment(name, n)
+
+
+def record_duration(stage, seconds):
+    _registry.record_duration(stage, seconds)
+
+
+def timer(stage):
+    return _registry.timer(stage)
+
+
+def timed(stage):
+    return _registry.timed(stage)
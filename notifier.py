@@ -1,38 +1,273 @@
 __author__ = 'esteele'
 
+import json
+import logging
 import socket
+import threading
 import conf
-from phue import Bridge, PhueRegistrationException, PhueRequestTimeout
-from pushover import Client
+import metrics
+# phue, requests and httplib are imported where they're used, so that runs
+#  which don't touch the lights or send notifications don't load them
 
 GREEN = 20389
 RED = 65535
 LIGHT_SET_OK = 1
 LIGHT_SET_FAILED_BRIDGE_COMMS = 2
 LIGHT_SET_FAILED_NOT_REGISTERED = 3
+LIGHT_SET_FAILED_UNKNOWN_LIGHT = 4
+BRIDGE_TIMEOUT_SECS = 10
+# Only stay on for 30 seconds (in tenths of a second)
+LIGHT_OFF_TRANSITION_TIME = 300
+PUSHOVER_MESSAGE_URL = "https://api.pushover.net/1/messages.json"
+PUSHOVER_TIMEOUT_SECS = 10
 
 
-def send_pushover_notification(message, title):
-    client = Client(conf.PUSHOVER_USER, api_token=conf.PUSHOVER_API_TOKEN)
-    return client.send_message(message, title=title, html=1)
-
-
-def set_lamp_state(is_late):
-    try:
-        b = Bridge(conf.HUE_BRIDGE_IP)
-    except PhueRequestTimeout:
-        return LIGHT_SET_FAILED_BRIDGE_COMMS
-    except socket.error:
-        return LIGHT_SET_FAILED_BRIDGE_COMMS
-    except PhueRegistrationException:
-        return LIGHT_SET_FAILED_NOT_REGISTERED
-
-    b.set_light(conf.HUE_LIGHT_NAME, 'on', True)  # Make sure it's on
-    b.set_light(conf.HUE_LIGHT_NAME, 'bri', 254)  # Max brightness
-    if is_late:
-        b.set_light(conf.HUE_LIGHT_NAME, 'hue', RED)
-    else:
-        b.set_light(conf.HUE_LIGHT_NAME, 'hue', GREEN)
-    # Only stay on for 30 seconds
-    b.set_light(conf.HUE_LIGHT_NAME, 'on', False, transitiontime=300)
-    return LIGHT_SET_OK
\ No newline at end of file
+class PushoverError(Exception):
+    """Pushover rejected a message"""
+    pass
+
+
+_pushover_session = None
+
+
+def get_pushover_session():
+    """The process-wide session for the Pushover API, created on first use
+
+    Messages are posted directly rather than with python-pushover, whose
+     client opens a new connection for each message and never times out.
+    """
+    global _pushover_session
+    if _pushover_session is None:
+        import requests
+        _pushover_session = requests.Session()
+    return _pushover_session
+
+
+@metrics.timed("pushover")
+def send_pushover_notification(message, title, device=None,
+                               timeout=PUSHOVER_TIMEOUT_SECS):
+    data = {"token": conf.PUSHOVER_API_TOKEN, "user": conf.PUSHOVER_USER,
+            "message": message, "title": title, "html": 1}
+    if device:
+        data["device"] = device
+    r = get_pushover_session().post(PUSHOVER_MESSAGE_URL, data=data,
+                                    timeout=timeout)
+    if 400 <= r.status_code < 500:
+        # The message itself was refused, e.g. an unknown device
+        raise PushoverError(r.json().get("errors"))
+    r.raise_for_status()
+    return r.json()
+
+
+class LightController(object):
+    """Drives Hue lights and groups with as few bridge commands as possible
+
+    Each state change is a single combined command, and only the attributes
+     that differ from the last state we applied are sent, so commands that
+     would change nothing are skipped. Several lights or groups are driven
+     in parallel, each over its own kept-alive connection to the bridge,
+     which is kept between calls.
+
+    Keep one controller for the life of the process to reuse the bridge
+     connection and the applied state.
+    """
+    def __init__(self, bridge_ip=None, username=None,
+                 timeout=BRIDGE_TIMEOUT_SECS):
+        self.bridge_ip = bridge_ip or conf.HUE_BRIDGE_IP
+        self.username = username or getattr(conf, "HUE_USERNAME", None)
+        self.timeout = timeout
+        self.bridge = None
+        self.light_ids = {}
+        self.group_ids = {}
+        self.applied_states = {}
+        self.command_count = 0
+        self.skipped_command_count = 0
+        self._lock = threading.Lock()
+        # {name: connection}, each used by one thread at a time under the
+        #  name's lock
+        self._connections = {}
+        self._name_locks = {}
+
+    def connect(self):
+        """Connect and look up light and group ids. Returns a LIGHT_SET_ code"""
+        if self.bridge is not None:
+            return LIGHT_SET_OK
+        from phue import Bridge, PhueRegistrationException, PhueRequestTimeout
+        try:
+            with metrics.timer("bridge_connect"):
+                bridge = Bridge(self.bridge_ip, self.username)
+                api = bridge.get_api()
+        except PhueRequestTimeout:
+            return LIGHT_SET_FAILED_BRIDGE_COMMS
+        except socket.error:
+            return LIGHT_SET_FAILED_BRIDGE_COMMS
+        except ValueError as e:
+            # phue doesn't check that the reply is JSON
+            logging.warning("Unreadable reply from bridge: %s", e)
+            return LIGHT_SET_FAILED_BRIDGE_COMMS
+        except PhueRegistrationException:
+            return LIGHT_SET_FAILED_NOT_REGISTERED
+        self.light_ids = dict((light["name"], light_id) for light_id, light
+                              in api.get("lights", {}).items())
+        self.group_ids = dict((group["name"], group_id) for group_id, group
+                              in api.get("groups", {}).items())
+        self.bridge = bridge
+        return LIGHT_SET_OK
+
+    def state_path(self, name):
+        if name in self.light_ids:
+            return "/api/%s/lights/%s/state" % (self.bridge.username,
+                                                self.light_ids[name])
+        elif name in self.group_ids:
+            return "/api/%s/groups/%s/action" % (self.bridge.username,
+                                                 self.group_ids[name])
+        return None
+
+    def _name_lock(self, name):
+        with self._lock:
+            return self._name_locks.setdefault(name, threading.Lock())
+
+    def _connection(self, name):
+        import httplib
+        connection = self._connections.get(name)
+        if connection is None:
+            connection = httplib.HTTPConnection(self.bridge.ip,
+                                                timeout=self.timeout)
+            self._connections[name] = connection
+        return connection
+
+    def _put(self, name, path, state):
+        """PUT state to path over name's connection. Hold name's lock"""
+        import httplib
+        body = json.dumps(state)
+        # The bridge may have closed an idle kept-alive connection, so retry
+        #  once on a fresh connection
+        for attempt in (1, 2):
+            connection = self._connection(name)
+            try:
+                connection.request("PUT", path, body)
+                return json.loads(connection.getresponse().read())
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                self._connections.pop(name, None)
+                if attempt == 2:
+                    raise
+
+    def state_changes(self, name, state):
+        """The parts of state that differ from what was last applied"""
+        applied = self.applied_states.get(name, {})
+        changes = dict((k, v) for k, v in state.items()
+                       if k != "transitiontime" and applied.get(k) != v)
+        if changes and "transitiontime" in state:
+            changes["transitiontime"] = state["transitiontime"]
+        return changes
+
+    def apply_states(self, name, states):
+        """Apply each state in turn to the named light or group"""
+        with self._name_lock(name):
+            self._apply_states(name, states)
+
+    def _apply_states(self, name, states):
+        path = self.state_path(name)
+        for state in states:
+            with self._lock:
+                changes = self.state_changes(name, state)
+                if not changes:
+                    self.skipped_command_count += 1
+                    metrics.increment("bridge_commands_skipped")
+                    continue
+                self.command_count += 1
+            metrics.increment("bridge_commands")
+            try:
+                with metrics.timer("bridge_command"):
+                    result = self._put(name, path, changes)
+            except Exception:
+                # We no longer know what state the light is in
+                with self._lock:
+                    self.applied_states.pop(name, None)
+                raise
+            # Usually a list of results, one per attribute
+            if not isinstance(result, list):
+                result = [result]
+            errors = [r["error"] for r in result
+                      if isinstance(r, dict) and "error" in r]
+            if errors:
+                logging.warning("Bridge reported errors for %s: %s",
+                                name, errors)
+            with self._lock:
+                applied = self.applied_states.setdefault(name, {})
+                applied.update((k, v) for k, v in changes.items()
+                               if k != "transitiontime")
+
+    def set_states(self, states_by_name):
+        """Apply {light or group name: [state, ...]} with names in parallel
+
+        Returns a LIGHT_SET_ code.
+        """
+        status = self.connect()
+        if status != LIGHT_SET_OK:
+            return status
+        unknown_names = [name for name in states_by_name
+                         if self.state_path(name) is None]
+        if unknown_names:
+            logging.error("No light or group named %s", unknown_names)
+            return LIGHT_SET_FAILED_UNKNOWN_LIGHT
+
+        failures = []
+
+        def apply_or_record_failure(name, states):
+            try:
+                self.apply_states(name, states)
+            except Exception as e:
+                logging.warning("Unable to set %s: %s", name, e)
+                failures.append(name)
+
+        threads = [threading.Thread(target=apply_or_record_failure,
+                                    args=(name, states))
+                   for name, states in states_by_name.items()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if failures:
+            metrics.increment("bridge_failures", len(failures))
+            return LIGHT_SET_FAILED_BRIDGE_COMMS
+        return LIGHT_SET_OK
+
+    def close(self):
+        """Close the kept-alive bridge connections"""
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+def lateness_states(is_late):
+    """Full brightness red or green, then fade out"""
+    return [{"on": True, "bri": 254, "hue": RED if is_late else GREEN},
+            {"on": False, "transitiontime": LIGHT_OFF_TRANSITION_TIME}]
+
+
+_light_controller = None
+
+
+def get_light_controller():
+    """The process-wide LightController, created on first use"""
+    global _light_controller
+    if _light_controller is None:
+        _light_controller = LightController()
+    return _light_controller
+
+
+def set_lamp_states(lateness_by_light_name, controller=None):
+    """Show {light or group name: is_late} on each light, in parallel"""
+    controller = controller or get_light_controller()
+    return controller.set_states(
+        dict((name, lateness_states(is_late))
+             for name, is_late in lateness_by_light_name.items()))
+
+
+def set_lamp_state(is_late, light_name=None, controller=None):
+    if light_name is None:
+        light_name = conf.HUE_LIGHT_NAME
+    return set_lamp_states({light_name: is_late}, controller)
@@ -0,0 +1,272 @@
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import conf
+import notifier
+
+__author__ = 'esteele'
+
+DEFAULT_OUTBOX_PATH = os.path.join(tempfile.gettempdir(),
+                                   "notifications-outbox.json")
+# Don't repeat a notification about the same trips within this period
+DEFAULT_DEDUP_WINDOW_SECS = 30 * 60
+# Messages queued within this period of each other are sent as one
+DEFAULT_COALESCE_SECS = 2
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_RETRY_BACKOFF_SECS = 1
+DEFAULT_FLUSH_TIMEOUT_SECS = 60
+# How long the worker waits before trying undelivered messages again
+DEFAULT_REDELIVERY_SECS = 60
+# A message claimed for sending longer ago than this is assumed lost in
+#  flight, even if the claiming process is still running
+DEFAULT_CLAIM_LEASE_SECS = 10 * 60
+
+
+def message_key(trip_ids, device, content):
+    if isinstance(content, unicode):
+        content = content.encode("utf-8")
+    content_hash = hashlib.sha1(content).hexdigest()
+    return "%s|%s|%s" % (",".join(sorted(trip_ids)), device or "",
+                         content_hash)
+
+
+def process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def coalesce(messages):
+    """Merge messages for the same device into one message per device"""
+    by_device = {}
+    for m in messages:
+        by_device.setdefault(m["device"], []).append(m)
+    merged = []
+    for device, device_messages in sorted(by_device.items()):
+        if len(device_messages) == 1:
+            merged.append(device_messages[0])
+            continue
+        merged.append({
+            "keys": [k for m in device_messages for k in m["keys"]],
+            "device": device,
+            "title": "; ".join(m["title"] for m in device_messages),
+            "message": "\n\n".join(m["message"] for m in device_messages),
+            "queued_at": min(m["queued_at"] for m in device_messages),
+        })
+    return merged
+
+
+class Outbox(object):
+    """Persistent, deduplicating queue of Pushover notifications
+
+    Messages are keyed by the trips they describe and a hash of their
+     content, and a message whose key was sent within the dedup window is
+     dropped. Queued messages are delivered by a background thread that
+     merges messages queued close together, and retries with backoff.
+     Messages that still couldn't be delivered are tried again every
+     redelivery_period seconds. The queue is kept in a file, so messages
+     that couldn't be delivered before the process exited are sent by the
+     next run. Messages stay queued while they're being sent, claimed by the
+     sending process, and are only removed once they've been delivered.
+    """
+    def __init__(self, path=None, dedup_window=None, coalesce_period=None,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_backoff=DEFAULT_RETRY_BACKOFF_SECS,
+                 send=notifier.send_pushover_notification,
+                 redelivery_period=None):
+        self.path = path or getattr(conf, "OUTBOX_FILE", DEFAULT_OUTBOX_PATH)
+        if dedup_window is None:
+            dedup_window = getattr(conf, "OUTBOX_DEDUP_WINDOW_SECS",
+                                   DEFAULT_DEDUP_WINDOW_SECS)
+        self.dedup_window = dedup_window
+        if coalesce_period is None:
+            coalesce_period = getattr(conf, "OUTBOX_COALESCE_SECS",
+                                      DEFAULT_COALESCE_SECS)
+        self.coalesce_period = coalesce_period
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.send = send
+        if redelivery_period is None:
+            redelivery_period = getattr(conf, "OUTBOX_REDELIVERY_SECS",
+                                        DEFAULT_REDELIVERY_SECS)
+        self.redelivery_period = redelivery_period
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+    def _locked_update(self, update):
+        """Apply update to the stored state while holding the file lock
+
+        The lock is shared with other processes using the same outbox file.
+        """
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = {"sent": {}, "pending": []}
+            result = update(state)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path) or ".")
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.rename(tmp_path, self.path)
+            return result
+
+    def enqueue(self, title, message, trip_ids, device=None,
+                dedup_content=None, force=False):
+        """Queue a message for delivery. Returns False if it's a duplicate
+
+        dedup_content is the part of the message that identifies it (by
+         default the whole message). force skips the duplicate check.
+        """
+        key = message_key(trip_ids, device,
+                          message if dedup_content is None else dedup_content)
+        now = time.time()
+
+        def add_unless_duplicate(state):
+            # Forget sends that are now outside the dedup window
+            state["sent"] = dict((k, sent_at) for k, sent_at
+                                 in state["sent"].items()
+                                 if now - sent_at < self.dedup_window)
+            pending_keys = set(k for m in state["pending"] for k in m["keys"])
+            if not force and (key in state["sent"] or key in pending_keys):
+                return False
+            state["pending"].append({"keys": [key], "device": device,
+                                     "title": title, "message": message,
+                                     "queued_at": now})
+            return True
+
+        queued = self._locked_update(add_unless_duplicate)
+        if queued:
+            self._start_worker()
+        else:
+            logging.info("Suppressing duplicate notification: %s", title)
+        return queued
+
+    def _start_worker(self):
+        with self._worker_lock:
+            self._idle.clear()
+            self._wake.set()
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run,
+                                                name="outbox")
+                self._worker.daemon = True
+                self._worker.start()
+
+    def _run(self):
+        retry_in = None
+        while True:
+            # Woken by a new message, or after retry_in to redeliver
+            if self._wake.wait(retry_in):
+                # Give the rest of a burst time to arrive so it's sent as one
+                time.sleep(self.coalesce_period)
+            with self._worker_lock:
+                self._wake.clear()
+            try:
+                delivered = self.deliver_pending()
+            except Exception:
+                logging.exception("Unable to deliver notifications")
+                delivered = False
+            if delivered:
+                retry_in = None
+            else:
+                logging.info("Retrying undelivered notifications in %s secs",
+                             self.redelivery_period)
+                retry_in = self.redelivery_period
+            with self._worker_lock:
+                if not self._wake.is_set():
+                    self._idle.set()
+
+    def _claim_pending(self):
+        """Claim the queued messages that no live process is sending"""
+        now = time.time()
+        pid = os.getpid()
+
+        def claim_unclaimed(state):
+            claimed = []
+            for m in state["pending"]:
+                claim = m.get("claim")
+                if claim and now - claim["at"] < DEFAULT_CLAIM_LEASE_SECS \
+                        and process_exists(claim["pid"]):
+                    continue
+                m["claim"] = {"pid": pid, "at": now}
+                claimed.append(m)
+            return claimed
+        return self._locked_update(claim_unclaimed)
+
+    def _deliver(self, m):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.send(m["message"], m["title"], m["device"])
+                return True
+            except Exception as e:
+                logging.warning("Notification attempt %d of %d failed: %s",
+                                attempt, self.max_attempts, e)
+                if attempt < self.max_attempts:
+                    time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+        return False
+
+    def deliver_pending(self):
+        """Send everything that's queued, in this thread"""
+        pending = self._claim_pending()
+        sent_keys = []
+        undelivered = []
+        for m in coalesce(pending):
+            logging.info("Sending pushover notification. Subject: %s",
+                         m["title"])
+            if self._deliver(m):
+                sent_keys.extend(m["keys"])
+            else:
+                undelivered.append(m)
+
+        now = time.time()
+        sent = set(sent_keys)
+        claimed = set(k for m in pending for k in m["keys"])
+
+        def record_delivery(state):
+            for k in sent_keys:
+                state["sent"][k] = now
+            remaining = []
+            for m in state["pending"]:
+                if sent.intersection(m["keys"]):
+                    continue
+                if claimed.intersection(m["keys"]):
+                    # Release failures for the next attempt
+                    m.pop("claim", None)
+                remaining.append(m)
+            state["pending"] = remaining
+        self._locked_update(record_delivery)
+        return len(undelivered) == 0
+
+    def flush(self, timeout=DEFAULT_FLUSH_TIMEOUT_SECS):
+        """Wait for queued messages to be delivered. Returns False on timeout
+
+        One-shot scripts should call this before exiting. Messages left
+         over from an earlier run are delivered too.
+        """
+        if self._locked_update(lambda state: bool(state["pending"])):
+            self._start_worker()
+        return self._idle.wait(timeout)
+
+
+_outbox = None
+
+
+def get_outbox():
+    """The process-wide Outbox, created on first use"""
+    global _outbox
+    if _outbox is None:
+        _outbox = Outbox()
+    return _outbox
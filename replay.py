@@ -0,0 +1,95 @@
+"""Recording realtime feed snapshots, and replaying them offline"""
+from datetime import datetime
+import glob
+import json
+import logging
+import os
+import tempfile
+import notifier
+
+__author__ = 'esteele'
+
+SNAPSHOT_FILENAME_FORMAT = "feed-%Y%m%dT%H%M%S.json"
+
+
+def record_snapshot(text, timestamp, directory):
+    """Save the raw feed text, named by the time the feed was retrieved
+
+    Returns the snapshot path. A snapshot that's already been recorded
+     (e.g. an unchanged feed in daemon mode) isn't written again.
+    """
+    path = os.path.join(
+        directory,
+        datetime.fromtimestamp(timestamp).strftime(SNAPSHOT_FILENAME_FORMAT))
+    if os.path.exists(path):
+        return path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "w") as f:
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        f.write(text)
+    os.rename(tmp_path, path)
+    logging.debug("Recorded feed snapshot %s", path)
+    return path
+
+
+def record_snapshot_file(source_path, timestamp, directory):
+    """As record_snapshot, for a feed that's already been saved to a file"""
+    with open(source_path) as f:
+        return record_snapshot(f.read(), timestamp, directory)
+
+
+def snapshot_paths(path):
+    """The snapshot at path, or every snapshot in it in time order"""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "feed-*.json")))
+    return [path]
+
+
+class ReplayFetcher(object):
+    """Stands in for feed.FeedFetcher, returning a recorded snapshot"""
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self.text = f.read()
+        self.snapshot = None
+
+    def fetch(self):
+        if self.snapshot is None:
+            self.snapshot = json.loads(self.text)
+        return self.snapshot
+
+
+class StubBackends(object):
+    """Backends for train_notify that record what would have been done
+
+    The clock is fixed and the device is always at location.
+    """
+    def __init__(self, location, now):
+        self.location = location
+        self._now = now
+        self.notifications = []
+        self.light_states = []
+
+    def now(self):
+        return self._now
+
+    def locate(self):
+        return self.location
+
+    def connect_lights(self):
+        return notifier.LIGHT_SET_OK
+
+    def set_lights(self, lateness_by_light_name):
+        self.light_states.append(dict(lateness_by_light_name))
+        return notifier.LIGHT_SET_OK
+
+    def queue_notification(self, title, message, trip_ids, device,
+                           dedup_content, force):
+        self.notifications.append((title, message, device))
+        return True
+
+    def flush_notifications(self):
+        return True
@@ -0,0 +1,157 @@
+"""Serves the latest trip status from memory over HTTP
+
+A single poller (train_notify.py --daemon --status-port) publishes each
+ run's summaries to a StatusBoard, and any number of clients read them from
+ here, so they cost no extra fetches of the realtime feed.
+
+    GET /status.json   Structured status
+    GET /status.txt    Short summaries of each subscription, as notified
+    GET /metrics       Stage timings and counters, in Prometheus text format
+
+Responses have an ETag, and a request with If-None-Match gets a 304 if the
+ status hasn't changed. Add ?wait=N to If-None-Match to long-poll: the
+ response is held for up to N seconds until the status changes.
+"""
+import hashlib
+import json
+import logging
+import math
+import SocketServer
+import threading
+import time
+import urlparse
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+import metrics
+
+__author__ = 'esteele'
+
+DEFAULT_STATUS_PORT = 8088
+MAX_WAIT_SECS = 120
+
+
+class StatusBoard(object):
+    """The latest published status, shared between the poller and clients"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.status = None
+        self.body = None
+        self.text = None
+        self.etag = None
+
+    def publish(self, status):
+        """Replace the status. Returns whether it changed"""
+        body = json.dumps(status, sort_keys=True, indent=1)
+        etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+        with self.condition:
+            if etag == self.etag:
+                return False
+            self.status = status
+            self.body = body
+            self.text = status_text(status)
+            self.etag = etag
+            self.condition.notify_all()
+        return True
+
+    def current(self, etag=None, wait=0):
+        """(etag, body, text), waiting up to wait seconds for a status whose
+         etag isn't etag
+        """
+        deadline = time.time() + wait
+        with self.condition:
+            while self.etag is None or self.etag == etag:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.etag, self.body, self.text
+
+
+def status_text(status):
+    lines = ["Retrieved at: %s" % (status["retrieved_at"],)]
+    for subscription in status["subscriptions"]:
+        lines.append("")
+        lines.append("%s: %s" % (subscription["name"],
+                                 subscription["subject"]))
+        lines.extend(subscription["short_summary"])
+    return "\n".join(lines) + "\n"
+
+
+def parse_wait(value):
+    """Seconds to long-poll for, from a ?wait= value, within
+     [0, MAX_WAIT_SECS]
+    """
+    try:
+        wait = float(value)
+    except ValueError:
+        return 0
+    if math.isnan(wait) or math.isinf(wait):
+        return 0
+    return max(0, min(wait, MAX_WAIT_SECS))
+
+
+def status_app(board):
+    """WSGI application serving board"""
+    def app(environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if environ["REQUEST_METHOD"] != "GET":
+            start_response("405 Method Not Allowed", [("Allow", "GET")])
+            return []
+        if path == "/metrics":
+            content = metrics.get_registry().prometheus_text()
+            start_response("200 OK", [
+                ("Content-Type", "text/plain; version=0.0.4"),
+                ("Content-Length", str(len(content)))])
+            return [content]
+        if path not in ("/status.json", "/status.txt"):
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return ["Not found\n"]
+
+        client_etag = environ.get("HTTP_IF_NONE_MATCH")
+        query = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+        wait = parse_wait(query.get("wait", ["0"])[0])
+        etag, body, text = board.current(client_etag,
+                                         wait if client_etag else 0)
+        if etag is None:
+            start_response("503 Service Unavailable",
+                           [("Content-Type", "text/plain"),
+                            ("Retry-After", "5")])
+            return ["No status yet\n"]
+        headers = [("ETag", etag), ("Cache-Control", "no-cache")]
+        if etag == client_etag:
+            start_response("304 Not Modified", headers)
+            return []
+        if path == "/status.json":
+            content_type, content = "application/json", body
+        else:
+            content_type, content = "text/plain; charset=utf-8", text
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        start_response("200 OK", headers + [
+            ("Content-Type", content_type),
+            ("Content-Length", str(len(content)))])
+        return [content]
+    return app
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    # Long-polling clients each hold a thread
+    daemon_threads = True
+
+
+class LoggingRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        logging.debug("Status request from %s: %s", self.client_address[0],
+                      format % args)
+
+
+def start_status_server(board, host="", port=DEFAULT_STATUS_PORT):
+    """Serve board on a background thread. Returns the server"""
+    server = make_server(host, port, status_app(board),
+                         server_class=ThreadingWSGIServer,
+                         handler_class=LoggingRequestHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name="status-server")
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving status on port %d", server.server_port)
+    return server
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import unittest
+import feed
+
+__author__ = 'esteele'
+
+FEED_TEXT = json.dumps({
+    "timestamp": 1760771234.5,
+    "delays": [{"tripId": "a", "start": "7:10", "stopId": "1",
+                "offsets": "7:10,3,7:40,4", "score": -0.25},
+               {"tripId": "b", "start": "7:20", "stopId": "2"}],
+    "transpositions": [1.5, -20, 3e2, True, None, u"café"],
+    "vehicles": [{"tripId": "a", "route": "R", "lp": "Here:1:2",
+                  "bearing": 12.75},
+                 {"tripId": "b", "route": "OTHER", "lp": "There:1:2"}],
+    "alerts": [{"tripId": "a", "title": u"Délai"},
+               {"tripId": "b", "title": "Other"}],
+    "version": 10})
+
+
+def expected_result(text, routes):
+    j = json.loads(text)
+    trip_ids = set(v["tripId"] for v in j["vehicles"] if v["route"] in routes)
+    result = dict((k, v) for k, v in j.items() if not isinstance(v, list))
+    for section in feed.RECORD_SECTIONS:
+        result[section] = [r for r in j[section] if r["tripId"] in trip_ids]
+    return result
+
+
+class StreamingFeedParserTest(unittest.TestCase):
+    def parse(self, chunks):
+        parser = feed.StreamingFeedParser(["R"])
+        for chunk in chunks:
+            parser.feed(chunk)
+        return parser.close()
+
+    def test_whole_document(self):
+        self.assertEqual(self.parse([FEED_TEXT]),
+                         expected_result(FEED_TEXT, ["R"]))
+
+    def test_split_at_every_offset(self):
+        expected = expected_result(FEED_TEXT, ["R"])
+        for offset in xrange(len(FEED_TEXT) + 1):
+            self.assertEqual(
+                self.parse([FEED_TEXT[:offset], FEED_TEXT[offset:]]),
+                expected, "Split at %d: %r" % (offset, FEED_TEXT[:offset]))
+
+    def test_one_character_at_a_time(self):
+        self.assertEqual(self.parse(list(FEED_TEXT)),
+                         expected_result(FEED_TEXT, ["R"]))
+
+    def test_number_split_before_fraction(self):
+        result = self.parse([u'{"timestamp": 1760771234.',
+                             u'5, "delays": [], "vehicles": [], '
+                             u'"alerts": []}'])
+        self.assertEqual(result["timestamp"], 1760771234.5)
+
+    def test_truncated_document(self):
+        parser = feed.StreamingFeedParser(["R"])
+        parser.feed(FEED_TEXT[:len(FEED_TEXT) // 2])
+        self.assertRaises(ValueError, parser.close)
+
+
+
+class SlowResponse(object):
+    """A 200 response whose body arrives a chunk every chunk_delay secs"""
+    status_code = 200
+    encoding = None
+
+    def __init__(self, text, chunk_delay=0, etag=None):
+        self.body = text.encode("utf-8")
+        self.chunk_delay = chunk_delay
+        self.headers = {"etag": etag} if etag else {}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for i in xrange(0, len(self.body), 16):
+            time.sleep(self.chunk_delay)
+            yield self.body[i:i + 16]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    def __init__(self):
+        self.responses = []
+        self.sent_headers = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.sent_headers.append(headers)
+        return self.responses.pop(0)
+
+
+class FeedFetcherTest(unittest.TestCase):
+    def fetcher(self, streaming):
+        fetcher = feed.FeedFetcher("http://feed", timeout=0.2,
+                                   streaming=streaming, routes=["R"])
+        fetcher.session = FakeSession()
+        return fetcher
+
+    def check_slow_body_uses_snapshot(self, streaming):
+        fetcher = self.fetcher(streaming)
+        fetcher.session.responses.append(SlowResponse(FEED_TEXT, 0))
+        snapshot = fetcher.fetch()
+        self.assertEqual(snapshot["version"], 10)
+
+        changed = FEED_TEXT.replace('"version": 10', '"version": 11')
+        fetcher.session.responses.append(SlowResponse(changed, 0.01))
+        start = time.time()
+        self.assertIs(fetcher.fetch(), snapshot)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_slow_body_uses_snapshot(self):
+        self.check_slow_body_uses_snapshot(streaming=False)
+
+    def test_slow_streamed_body_uses_snapshot(self):
+        self.check_slow_body_uses_snapshot(streaming=True)
+
+    def test_unparseable_body_isnt_revalidated(self):
+        fetcher = self.fetcher(streaming=False)
+        fetcher.session.responses.extend([
+            SlowResponse(FEED_TEXT, etag='"a"'),
+            SlowResponse("b", etag='"b"'),
+            SlowResponse(FEED_TEXT, etag='"c"')])
+        snapshot = fetcher.fetch()
+        self.assertIs(fetcher.fetch(), snapshot)
+        fetcher.fetch()
+        self.assertEqual(fetcher.session.sent_headers,
+                         [{}, {"If-None-Match": '"a"'},
+                          {"If-None-Match": '"a"'}])
+
+    def test_slow_first_body_is_unavailable(self):
+        fetcher = self.fetcher(streaming=False)
+        fetcher.session.responses.append(SlowResponse(FEED_TEXT, 0.01))
+        self.assertRaises(feed.FeedUnavailable, fetcher.fetch)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+from datetime import timedelta
+import unittest
+import history
+import train_notify
+
+__author__ = 'esteele'
+
+TIMESTAMP = 1792360800
+
+
+def extract_trip(stop_id, boarding_stop_id=None):
+    feed_index = {"t1": {"delay": {"tripId": "t1", "start": "7:00",
+                                   "stopId": str(stop_id),
+                                   "offsets": "7:00,12,7:30,15"},
+                         "vehicle": None, "alert": None}}
+    return train_notify.extract_trip(feed_index, "t1", timedelta(0),
+                                     timedelta(days=1), boarding_stop_id)
+
+
+class HistoryStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = history.HistoryStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def recorded(self):
+        self.store.flush()
+        return self.store.connection.execute(
+            "SELECT trip_id, delay_mins, boarding_stop_id "
+            "FROM delay_snapshots").fetchall()
+
+    def test_trip_without_arrival_estimate_isnt_recorded(self):
+        # conf.transit_times has no entry for an unknown origin stop
+        trip = extract_trip(99)
+        self.assertEqual(trip.est_scheduled_arrival_earliest, timedelta.max)
+        self.store.record([trip], TIMESTAMP)
+        self.assertEqual(self.recorded(), [])
+
+    def test_usual_delay_is_kept_per_boarding_stop(self):
+        trip = extract_trip(1)
+        self.store.record([trip], TIMESTAMP)
+        self.assertEqual(self.recorded(),
+                         [("t1", trip.estimate_delay_at_boarding_station(),
+                           history.NO_STOP_ID)])
+        weekday = self.store.connection.execute(
+            "SELECT weekday FROM delay_snapshots").fetchone()[0]
+        self.assertEqual(self.store.usual_delay(trip, weekday),
+                         trip.estimate_delay_at_boarding_station())
+        self.assertIsNone(self.store.usual_delay(extract_trip(1, 2), weekday))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import unittest
+import locator
+
+__author__ = 'esteele'
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "fixtures")
+PROC_NET_ARP_PATH = os.path.join(FIXTURES_DIR, "proc_net_arp.txt")
+IP_NEIGH_PATH = os.path.join(FIXTURES_DIR, "ip_neigh.txt")
+
+
+def read_fixture(path):
+    with open(path) as f:
+        return f.read()
+
+
+class NeighborTableTest(unittest.TestCase):
+    def test_parse_proc_net_arp(self):
+        self.assertEqual(
+            locator.parse_proc_net_arp(read_fixture(PROC_NET_ARP_PATH)),
+            {"192.168.1.1": locator.NEIGHBOR_REACHABLE,
+             "192.168.1.20": locator.NEIGHBOR_REACHABLE,
+             "192.168.1.30": locator.NEIGHBOR_FAILED,
+             "192.168.1.40": locator.NEIGHBOR_REACHABLE})
+
+    def test_parse_ip_neigh(self):
+        self.assertEqual(
+            locator.parse_ip_neigh(read_fixture(IP_NEIGH_PATH)),
+            {"192.168.1.1": locator.NEIGHBOR_REACHABLE,
+             "192.168.1.20": locator.NEIGHBOR_STALE,
+             "192.168.1.21": locator.NEIGHBOR_STALE,
+             "192.168.1.30": locator.NEIGHBOR_FAILED,
+             "192.168.1.31": locator.NEIGHBOR_FAILED,
+             "192.168.1.40": locator.NEIGHBOR_REACHABLE,
+             "fe80::1": locator.NEIGHBOR_STALE})
+
+    def test_read_neighbor_table_detects_format(self):
+        self.assertEqual(
+            locator.read_neighbor_table(PROC_NET_ARP_PATH),
+            locator.parse_proc_net_arp(read_fixture(PROC_NET_ARP_PATH)))
+        self.assertEqual(
+            locator.read_neighbor_table(IP_NEIGH_PATH),
+            locator.parse_ip_neigh(read_fixture(IP_NEIGH_PATH)))
+
+
+class PassiveLocateTest(unittest.TestCase):
+    def setUp(self):
+        self.neighbor_table = locator.read_neighbor_table(IP_NEIGH_PATH)
+        self.probed = []
+        self.real_locate = locator.locate
+        locator.locate = self.fake_locate
+
+    def tearDown(self):
+        locator.locate = self.real_locate
+
+    def fake_locate(self, host_tuples, ping_period):
+        self.probed.append(host_tuples)
+        return host_tuples[0][1]
+
+    def passive_locate(self, host_tuples):
+        return locator.passive_locate(host_tuples, 1, self.neighbor_table)
+
+    def test_reachable_host_is_not_probed(self):
+        self.assertEqual(self.passive_locate([("192.168.1.20", "stale"),
+                                              ("192.168.1.1", "home")]),
+                         "home")
+        self.assertEqual(self.probed, [])
+
+    def test_only_stale_and_unknown_hosts_are_probed(self):
+        self.assertEqual(self.passive_locate([("192.168.1.30", "failed"),
+                                              ("192.168.1.20", "stale"),
+                                              ("10.0.0.1", "unknown"),
+                                              ("192.168.1.31", "incomplete")]),
+                         "stale")
+        self.assertEqual(self.probed, [[("192.168.1.20", "stale"),
+                                        ("10.0.0.1", "unknown")]])
+
+    def test_failed_hosts_are_not_found_without_probing(self):
+        self.assertEqual(self.passive_locate([("192.168.1.30", "failed"),
+                                              ("192.168.1.31", "incomplete")]),
+                         locator.NOT_FOUND)
+        self.assertEqual(self.probed, [])
+
+
+class LocationDebouncerTest(unittest.TestCase):
+    def observe_all(self, debouncer, locations):
+        """The (previous, current) of each change confirmed by locations"""
+        changes = [debouncer.observe(location, now)
+                   for now, location in enumerate(locations)]
+        return [(c.previous, c.current) for c in changes if c is not None]
+
+    def test_found_somewhere_else_is_confirmed_at_once(self):
+        debouncer = locator.LocationDebouncer("home", found_confirmations=1)
+        self.assertEqual(self.observe_all(debouncer, ["home", "work"]),
+                         [("home", "work")])
+        self.assertEqual(debouncer.location, "work")
+
+    def test_brief_loss_is_ignored(self):
+        debouncer = locator.LocationDebouncer("home", lost_confirmations=3)
+        self.assertEqual(
+            self.observe_all(debouncer, [locator.NOT_FOUND, locator.NOT_FOUND,
+                                         "home", locator.NOT_FOUND, "home"]),
+            [])
+        self.assertFalse(debouncer.pending)
+        self.assertEqual(debouncer.location, "home")
+
+    def test_loss_needs_consecutive_confirmations(self):
+        debouncer = locator.LocationDebouncer("home", lost_confirmations=3)
+        self.assertEqual(self.observe_all(debouncer, [locator.NOT_FOUND] * 2),
+                         [])
+        self.assertTrue(debouncer.pending)
+        self.assertEqual(self.observe_all(debouncer, [locator.NOT_FOUND]),
+                         [("home", locator.NOT_FOUND)])
+        self.assertFalse(debouncer.pending)
+
+    def test_changing_candidate_restarts_confirmation(self):
+        debouncer = locator.LocationDebouncer("home", found_confirmations=2)
+        self.assertEqual(self.observe_all(debouncer, ["work", "gym", "work"]),
+                         [])
+        self.assertEqual(self.observe_all(debouncer, ["work"]),
+                         [("home", "work")])
+
+
+class AdaptiveIntervalTest(unittest.TestCase):
+    def test_backs_off_to_max_and_tightens(self):
+        interval = locator.AdaptiveInterval(5, 45)
+        secs = []
+        for _ in xrange(5):
+            secs.append(interval.secs)
+            interval.back_off()
+        self.assertEqual(secs, [5, 10, 20, 40, 45])
+        interval.tighten()
+        self.assertEqual(interval.secs, 5)
+
+    def test_max_below_min(self):
+        interval = locator.AdaptiveInterval(5, 1)
+        interval.back_off()
+        self.assertEqual(interval.secs, 5)
+
+    def test_passive_polling_doesnt_back_off(self):
+        polled = []
+        real_location_changes = locator.location_changes
+        locator.location_changes = \
+            lambda observe, min_interval, max_interval, **kwargs: \
+            polled.append((min_interval, max_interval))
+        try:
+            locator.passive_location_changes([("192.168.1.1", "home")], 1,
+                                             IP_NEIGH_PATH)
+        finally:
+            locator.location_changes = real_location_changes
+        self.assertEqual(polled, [(locator.DEFAULT_NEIGHBOR_POLL_SECS,
+                                   locator.DEFAULT_NEIGHBOR_POLL_SECS)])
+
+
+class LocationCacheTest(unittest.TestCase):
+    def test_unwritable_cache_doesnt_stop_location_changes(self):
+        path = os.path.join(FIXTURES_DIR, "no-such-dir", "location.json")
+        locations = iter(["home", "home", "work", "work"])
+        changes = locator.location_changes(
+            lambda: next(locations), 0, 0,
+            location_observed=lambda location:
+            locator.cache_location(location, path))
+        self.assertEqual(next(changes).current, "work")
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from fake_hue_bridge import FakeHueBridge, FAKE_USERNAME
+import notifier
+
+__author__ = 'esteele'
+
+
+class LightControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeHueBridge(light_names=("Lamp",)).start()
+        self.controller = notifier.LightController(self.bridge.address,
+                                                   FAKE_USERNAME)
+
+    def tearDown(self):
+        self.controller.close()
+        self.bridge.stop()
+
+    def put_commands(self):
+        return [state for _, _, state in self.bridge.state_commands]
+
+    def test_unchanged_rerun_only_sends_changes(self):
+        self.assertEqual(notifier.set_lamp_state(True, "Lamp",
+                                                 self.controller),
+                         notifier.LIGHT_SET_OK)
+        self.assertEqual(self.bridge.request_counts["PUT"], 2)
+
+        del self.bridge.state_commands[:]
+        self.assertEqual(notifier.set_lamp_state(True, "Lamp",
+                                                 self.controller),
+                         notifier.LIGHT_SET_OK)
+        self.assertEqual(self.bridge.request_counts["PUT"], 4)
+        commands = self.put_commands()
+        self.assertEqual(len(commands), 2)
+        for state in commands:
+            self.assertTrue(set(state) <= set(["on", "transitiontime"]),
+                            state)
+        self.assertEqual(commands[0], {"on": True})
+        self.assertEqual(commands[1],
+                         {"on": False, "transitiontime":
+                          notifier.LIGHT_OFF_TRANSITION_TIME})
+
+    def test_unknown_light(self):
+        self.assertEqual(notifier.set_lamp_state(True, "Nowhere",
+                                                 self.controller),
+                         notifier.LIGHT_SET_FAILED_UNKNOWN_LIGHT)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import outbox
+
+__author__ = 'esteele'
+
+
+class RecordingSender(object):
+    """Stands in for notifier.send_pushover_notification
+
+    The first fail_count sends raise, and later ones are recorded.
+    """
+    def __init__(self, fail_count=0):
+        self.fail_count = fail_count
+        self.sent = []
+        self.sent_event = threading.Event()
+
+    def __call__(self, message, title, device=None):
+        if self.fail_count > 0:
+            self.fail_count -= 1
+            raise IOError("Pushover unavailable")
+        self.sent.append((title, message, device))
+        self.sent_event.set()
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "outbox.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def outbox(self, send, **kwargs):
+        kwargs.setdefault("coalesce_period", 0)
+        kwargs.setdefault("retry_backoff", 0)
+        return outbox.Outbox(self.path, send=send, **kwargs)
+
+    def stored(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_duplicate_is_suppressed(self):
+        send = RecordingSender()
+        box = self.outbox(send)
+        self.assertTrue(box.enqueue("1 train late", "Body", ["a", "b"]))
+        self.assertFalse(box.enqueue("1 train late", "Body", ["b", "a"]))
+        self.assertTrue(box.flush(timeout=5))
+        # Still a duplicate once sent, within the dedup window
+        self.assertFalse(box.enqueue("1 train late", "Body", ["a", "b"]))
+        self.assertTrue(box.enqueue("1 train late", "Body", ["a", "b"],
+                                    force=True))
+        self.assertTrue(box.enqueue("1 train late", "Other", ["a", "b"]))
+        self.assertTrue(box.flush(timeout=5))
+        # The last two may or may not have been coalesced
+        self.assertEqual(sorted(body for _, message, _ in send.sent
+                                for body in message.split("\n\n")),
+                         ["Body", "Body", "Other"])
+
+    def test_dedup_content(self):
+        box = self.outbox(RecordingSender())
+        self.assertTrue(box.enqueue("Late", "At 7:01", ["a"],
+                                    dedup_content="Late"))
+        self.assertFalse(box.enqueue("Late", "At 7:02", ["a"],
+                                     dedup_content="Late"))
+        self.assertTrue(box.flush(timeout=5))
+
+    def test_burst_is_coalesced_per_device(self):
+        send = RecordingSender()
+        box = self.outbox(send, coalesce_period=0.5)
+        box.enqueue("A", "First", ["a"])
+        box.enqueue("B", "Second", ["b"])
+        box.enqueue("C", "Third", ["c"], device="phone")
+        self.assertTrue(box.flush(timeout=5))
+        self.assertEqual(sorted(send.sent),
+                         [("A; B", "First\n\nSecond", None),
+                          ("C", "Third", "phone")])
+        self.assertEqual(self.stored()["pending"], [])
+        self.assertEqual(len(self.stored()["sent"]), 3)
+
+    def test_undelivered_is_redelivered_without_another_message(self):
+        send = RecordingSender(fail_count=2)
+        box = self.outbox(send, max_attempts=1, redelivery_period=0.1)
+        box.enqueue("A", "First", ["a"])
+        self.assertTrue(send.sent_event.wait(5))
+        self.assertTrue(box.flush(timeout=5))
+        self.assertEqual(send.sent, [("A", "First", None)])
+        self.assertEqual(self.stored()["pending"], [])
+
+    def test_message_stays_queued_while_being_sent(self):
+        release = threading.Event()
+        box = self.outbox(lambda *args: release.wait())
+        box.enqueue("A", "First", ["a"])
+        self.assertFalse(box.flush(timeout=0.5))
+        pending = self.stored()["pending"]
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0]["claim"]["pid"], os.getpid())
+
+        # The claim is held by a live process, so isn't taken over
+        send = RecordingSender()
+        self.assertTrue(self.outbox(send).flush(timeout=5))
+        self.assertEqual(send.sent, [])
+        release.set()
+        self.assertTrue(box.flush(timeout=5))
+        self.assertEqual(self.stored()["pending"], [])
+
+    def test_claim_of_exited_process_is_taken_over(self):
+        release = threading.Event()
+        box = self.outbox(lambda *args: release.wait())
+        box.enqueue("A", "First", ["a"])
+        box.flush(timeout=0.5)
+
+        real_process_exists = outbox.process_exists
+        outbox.process_exists = lambda pid: False
+        try:
+            send = RecordingSender()
+            self.assertTrue(self.outbox(send).flush(timeout=5))
+        finally:
+            outbox.process_exists = real_process_exists
+            release.set()
+        self.assertEqual(send.sent, [("A", "First", None)])
+        self.assertTrue(box.flush(timeout=5))
+        self.assertEqual(self.stored()["pending"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import unittest
+import benchmark
+
+__author__ = 'esteele'
+
+REPEAT = 3
+
+
+class StartupTest(unittest.TestCase):
+    def best_import(self, module_name):
+        return min((benchmark.time_import(module_name)
+                    for _ in xrange(REPEAT)), key=lambda r: r["total"])
+
+    def test_entry_points_import_lazily_within_budget(self):
+        for module_name in benchmark.STARTUP_ENTRY_POINTS:
+            result = self.best_import(module_name)
+            eager = [m for m in benchmark.LAZY_MODULES
+                     if m in result["modules"]]
+            self.assertEqual(eager, [], "%s imported %s eagerly" %
+                             (module_name, ", ".join(eager)))
+            self.assertLessEqual(result["total"],
+                                 benchmark.DEFAULT_STARTUP_BUDGET_SECS,
+                                 "%s took %.1fms to import" %
+                                 (module_name, result["total"] * 1000))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import time
+import unittest
+import status_server
+
+__author__ = 'esteele'
+
+
+class ParseWaitTest(unittest.TestCase):
+    def test_non_finite_waits_are_rejected(self):
+        for value in ("nan", "inf", "-inf", "oops"):
+            self.assertEqual(status_server.parse_wait(value), 0, value)
+
+    def test_wait_is_clamped(self):
+        self.assertEqual(status_server.parse_wait("-5"), 0)
+        self.assertEqual(status_server.parse_wait("2.5"), 2.5)
+        self.assertEqual(status_server.parse_wait("1e9"),
+                         status_server.MAX_WAIT_SECS)
+
+
+class StatusAppTest(unittest.TestCase):
+    def test_nan_wait_doesnt_hold_the_request(self):
+        board = status_server.StatusBoard()
+        board.publish({"retrieved_at": "now", "subscriptions": []})
+        statuses = []
+        environ = {"REQUEST_METHOD": "GET", "PATH_INFO": "/status.json",
+                   "QUERY_STRING": "wait=nan",
+                   "HTTP_IF_NONE_MATCH": board.etag}
+        start = time.time()
+        status_server.status_app(board)(
+            environ, lambda status, headers: statuses.append(status))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(statuses, ["304 Not Modified"])
+
+
+if __name__ == "__main__":
+    unittest.main()
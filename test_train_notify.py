@@ -0,0 +1,98 @@
+from datetime import timedelta
+import itertools
+import unittest
+import train_notify
+
+__author__ = 'esteele'
+
+
+def feed_index(starts_and_offsets):
+    """A feed index of trips "t0", "t1", ... starting from stop 1"""
+    index = {}
+    for n, (start, offsets) in enumerate(starts_and_offsets):
+        trip_id = "t%d" % (n,)
+        index[trip_id] = {"delay": {"tripId": trip_id, "start": start,
+                                    "stopId": "1", "offsets": offsets},
+                          "vehicle": None, "alert": None}
+    return index
+
+
+def dropwhile_delay_from(offsets, earliest):
+    """delay_from as it was before OffsetTimeline, over the raw string"""
+    raw = offsets.split(",") if offsets else []
+    offset_tuples = zip(
+        [train_notify.hhmm_string_to_timedelta(x)
+         for x in itertools.islice(raw, 0, None, 2)],
+        map(int, itertools.islice(raw, 1, None, 2)))
+    possible_delay_tuples = list(itertools.dropwhile(
+        lambda x: x[0] < earliest, offset_tuples))
+    if possible_delay_tuples:
+        return possible_delay_tuples[0][1]
+    return 0
+
+
+class OffsetTimelineTest(unittest.TestCase):
+    OFFSETS = [
+        "",
+        "14:15,16",
+        "14:15,16,17:10,14,17:42,13,18:25,11,19:57,10,20:20,9",
+        # Unsorted, with a repeated time
+        "17:10,14,14:15,16,17:42,13,17:42,7,9:05,2",
+        # An odd trailing time has no delay
+        "14:15,16,17:10",
+        # After midnight
+        "23:50,4,24:10,5,25:00,6",
+    ]
+
+    def earliest_times(self):
+        for minutes in xrange(8 * 60, 26 * 60, 7):
+            for seconds in (0, 1, 30, 59):
+                yield timedelta(minutes=minutes, seconds=seconds)
+        yield timedelta(0)
+        yield timedelta.max
+
+    def test_matches_dropwhile(self):
+        for offsets in self.OFFSETS:
+            for earliest in self.earliest_times():
+                self.assertEqual(
+                    train_notify.OffsetTimeline(offsets).delay_from(earliest),
+                    dropwhile_delay_from(offsets, earliest),
+                    "%r from %s" % (offsets, earliest))
+
+    def test_seconds_round_up(self):
+        timeline = train_notify.OffsetTimeline("7:10,3,7:11,4")
+        self.assertEqual(timeline.delay_from(timedelta(hours=7, minutes=10)),
+                         3)
+        self.assertEqual(
+            timeline.delay_from(timedelta(hours=7, minutes=10, seconds=1)), 4)
+
+    def test_round_trips_to_string(self):
+        for offsets in self.OFFSETS[:4]:
+            timeline = train_notify.OffsetTimeline(offsets)
+            len(timeline)
+            self.assertEqual(timeline.to_string(), offsets)
+
+
+class EvaluateTripsTest(unittest.TestCase):
+    def setUp(self):
+        # conf.transit_times has trips from stop 1 arriving 10-15 mins later
+        index = feed_index([("%d:00" % (hour,), "%d:00,3,%d:30,6" %
+                             (hour, hour)) for hour in xrange(5, 20)])
+        self.trips = [train_notify.extract_trip(index, trip_id,
+                                                timedelta(hours=7),
+                                                timedelta(hours=8))
+                      for trip_id in sorted(index)]
+
+    def test_only_selected_trips_are_parsed(self):
+        _, short_summaries, _, late_trip_ids = \
+            train_notify.evaluate_trips(self.trips, 5, timedelta(hours=6),
+                                        full_summaries=False)
+        self.assertEqual(len(short_summaries), 1)
+        self.assertEqual(late_trip_ids, ["t2"])
+        self.assertEqual(
+            [t.trip_id for t in self.trips if t.offsets._minutes is not None],
+            ["t2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
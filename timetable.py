@@ -0,0 +1,225 @@
+"""Stop to stop transit times, precomputed from a GTFS static timetable
+
+import_gtfs() reads the timetable's stop_times.txt once, and writes the
+ shortest and longest scheduled time between every pair of stops served in
+ order by a trip, as a sorted sparse matrix file. TransitMatrix memory-maps
+ that file, so loading it doesn't depend on the size of the network, and
+ looks pairs up with a binary search of the mapped records.
+"""
+import argparse
+import bisect
+import codecs
+import csv
+from datetime import timedelta
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import conf
+
+__author__ = 'esteele'
+
+MATRIX_MAGIC = "TTM1"
+HEADER = struct.Struct("<4sI")
+# (from stop id << 32 | to stop id, min transit secs, max transit secs)
+RECORD = struct.Struct("<qii")
+KEY = struct.Struct("<q")
+
+
+def gtfs_time_to_seconds(s):
+    """hh:mm:ss to seconds. Hours may be 24 or more for trips after midnight"""
+    hours, minutes, seconds = s.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def pair_key(from_stop_id, to_stop_id):
+    return (from_stop_id << 32) | to_stop_id
+
+
+def open_gtfs_file(gtfs_path, name):
+    """A file from a GTFS directory or zip"""
+    if os.path.isdir(gtfs_path):
+        return open(os.path.join(gtfs_path, name), "rb")
+    import zipfile
+    return zipfile.ZipFile(gtfs_path).open(name)
+
+
+def read_stop_times(gtfs_path):
+    """{trip_id: [(stop_sequence, stop_id, arrival, departure)]}
+
+    Times are in seconds. Stops without times (which some feeds leave for
+     stops between timepoints) and stops whose ids aren't numbers (which
+     the realtime feed can't refer to) are left out.
+    """
+    stop_times = {}
+    f = open_gtfs_file(gtfs_path, "stop_times.txt")
+    try:
+        reader = csv.reader(f)
+        header = [column.strip() for column in next(reader)]
+        if header and header[0].startswith(codecs.BOM_UTF8):
+            header[0] = header[0][len(codecs.BOM_UTF8):]
+        trip_col = header.index("trip_id")
+        sequence_col = header.index("stop_sequence")
+        stop_col = header.index("stop_id")
+        arrival_col = header.index("arrival_time")
+        departure_col = header.index("departure_time")
+        for row in reader:
+            arrival = row[arrival_col].strip()
+            departure = row[departure_col].strip()
+            stop_id = row[stop_col].strip()
+            if not (arrival and departure and stop_id.isdigit()):
+                continue
+            stop_times.setdefault(row[trip_col], []).append(
+                (int(row[sequence_col]), int(stop_id),
+                 gtfs_time_to_seconds(arrival),
+                 gtfs_time_to_seconds(departure)))
+    finally:
+        f.close()
+    return stop_times
+
+
+def trip_patterns(stop_times):
+    """The distinct stopping patterns of the trips in stop_times
+
+    A pattern is the trip's stops with their times relative to its first
+     departure. Most trips share a pattern with many others (the same
+     service at a different time of day), and they all have the same
+     transit times.
+    """
+    patterns = set()
+    for stops in stop_times.itervalues():
+        stops.sort()
+        origin_departure = stops[0][3]
+        patterns.add(tuple((stop_id, arrival - origin_departure,
+                            departure - origin_departure)
+                           for _, stop_id, arrival, departure in stops))
+    return patterns
+
+
+def transit_ranges(patterns):
+    """{pair key: [min secs, max secs]} between every pair of stops served in
+     order by a pattern
+    """
+    ranges = {}
+    for pattern in patterns:
+        for i, (from_stop_id, _, departure) in enumerate(pattern):
+            for to_stop_id, arrival, _ in pattern[i + 1:]:
+                transit = arrival - departure
+                key = pair_key(from_stop_id, to_stop_id)
+                r = ranges.get(key)
+                if r is None:
+                    ranges[key] = [transit, transit]
+                elif transit < r[0]:
+                    r[0] = transit
+                elif transit > r[1]:
+                    r[1] = transit
+    return ranges
+
+
+def write_matrix(ranges, path):
+    """Write ranges sorted by key, replacing any existing matrix atomically"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(HEADER.pack(MATRIX_MAGIC, len(ranges)))
+        pack = RECORD.pack
+        for key in sorted(ranges):
+            f.write(pack(key, *ranges[key]))
+    os.rename(tmp_path, path)
+
+
+def import_gtfs(gtfs_path, matrix_path):
+    """Build a transit matrix file from a GTFS directory or zip
+
+    Returns the number of stop pairs in the matrix.
+    """
+    stop_times = read_stop_times(gtfs_path)
+    patterns = trip_patterns(stop_times)
+    ranges = transit_ranges(patterns)
+    logging.info("%d trips in %d patterns give %d stop pairs",
+                 len(stop_times), len(patterns), len(ranges))
+    write_matrix(ranges, matrix_path)
+    return len(ranges)
+
+
+class _MappedKeys(object):
+    """The record keys of a mapped matrix, as a sequence bisect can search"""
+    def __init__(self, buf, count):
+        self.buf = buf
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return KEY.unpack_from(self.buf, HEADER.size + i * RECORD.size)[0]
+
+
+class TransitMatrix(object):
+    """Read-only view of a transit matrix file written by import_gtfs"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = HEADER.unpack_from(self.buf)
+        if magic != MATRIX_MAGIC or \
+                len(self.buf) != HEADER.size + count * RECORD.size:
+            self.buf.close()
+            raise ValueError("%s is not a transit matrix" % (path,))
+        self.keys = _MappedKeys(self.buf, count)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def transit_times(self, from_stop_id, to_stop_id):
+        """(min, max) scheduled transit as timedeltas, or None if no trip
+         serves from_stop_id then to_stop_id
+        """
+        key = pair_key(from_stop_id, to_stop_id)
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys):
+            return None
+        record_key, min_secs, max_secs = RECORD.unpack_from(
+            self.buf, HEADER.size + i * RECORD.size)
+        if record_key != key:
+            return None
+        return timedelta(seconds=min_secs), timedelta(seconds=max_secs)
+
+    def close(self):
+        self.buf.close()
+
+
+_transit_matrix = None
+_transit_matrix_loaded = False
+
+
+def get_transit_matrix():
+    """The process-wide TransitMatrix from conf.TRANSIT_MATRIX_FILE
+
+    Returns None if there's no matrix configured, or it can't be read.
+    """
+    global _transit_matrix, _transit_matrix_loaded
+    if not _transit_matrix_loaded:
+        _transit_matrix_loaded = True
+        path = getattr(conf, "TRANSIT_MATRIX_FILE", None)
+        if path:
+            try:
+                _transit_matrix = TransitMatrix(path)
+            except (EnvironmentError, ValueError) as e:
+                logging.warning("Unable to load transit matrix %s: %s - "
+                                "using conf.transit_times", path, e)
+    return _transit_matrix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a transit matrix from a GTFS static timetable")
+    parser.add_argument("gtfs_path", help="GTFS directory or zip")
+    parser.add_argument("matrix_path", nargs="?",
+                        default=getattr(conf, "TRANSIT_MATRIX_FILE", None))
+    args = parser.parse_args()
+    if not args.matrix_path:
+        parser.error("No matrix_path given and no conf.TRANSIT_MATRIX_FILE")
+    logging.basicConfig(level=logging.INFO)
+    import_gtfs(args.gtfs_path, args.matrix_path)
@@ -1,21 +1,108 @@
 import argparse
+from array import array
+import bisect
 from datetime import datetime, timedelta
 import itertools
 import logging
-import requests
+import sys
+import threading
+import time
 import conf
+import feed
 import locator
+import metrics
 import notifier
+import outbox
+import replay
+import timetable
 
 BASE_URL = "http://realtime.grofsoft.com/tripview/realtime?routes=%s&type=dtva"
 DEFAULT_LATENESS_THRESHOLD_MINS = 5
 SEND_NOTIFICATION_ALWAYS = "always"
 SEND_NOTIFICATION_AUTO = "auto"
 SEND_NOTIFICATION_NEVER = "never"
+DEFAULT_DAEMON_INTERVAL_SECS = 60
+
+
+class OffsetTimeline(object):
+    """Delays along a trip, from the feed's offsets string
+
+    offsets is a string of comma sep list of alternating times and delays
+     e.g. "14:15,16,17:10,14,17:42,13,18:25,11,19:57,10,20:20,9"
+     It's only parsed when first needed, into parallel arrays of minutes
+     since midnight and delays, so that lookups can use binary search.
+    """
+    __slots__ = ("_raw", "_minutes", "_delays", "_is_sorted")
+
+    def __init__(self, raw=""):
+        self._raw = raw
+        self._minutes = None
+        self._delays = None
+        self._is_sorted = True
+
+    def _parse(self):
+        tokens = self._raw.split(",") if self._raw else []
+        # An odd trailing time has no delay, so is ignored
+        pair_count = len(tokens) // 2
+        self._minutes = array("i", [hhmm_string_to_minutes(x)
+                                    for x in tokens[0:pair_count * 2:2]])
+        self._delays = array("i", [int(x)
+                                   for x in tokens[1:pair_count * 2:2]])
+        self._is_sorted = all(a <= b for a, b in
+                              itertools.izip(self._minutes,
+                                             itertools.islice(self._minutes,
+                                                              1, None)))
+        self._raw = None
+
+    def to_string(self):
+        """In the feed's offsets format"""
+        if self._minutes is None:
+            return self._raw
+        return ",".join("%d:%02d,%d" % (minutes // 60, minutes % 60, delay)
+                        for minutes, delay in itertools.izip(self._minutes,
+                                                             self._delays))
+
+    def __len__(self):
+        if self._minutes is None:
+            self._parse()
+        return len(self._minutes)
+
+    def __iter__(self):
+        """(timedelta, delay) pairs"""
+        if self._minutes is None:
+            self._parse()
+        for minutes, delay in itertools.izip(self._minutes, self._delays):
+            yield timedelta(minutes=minutes), delay
+
+    def delay_from(self, earliest):
+        """The first delay at or after timedelta earliest, or 0 if none"""
+        if self._minutes is None:
+            self._parse()
+        # Round up, so no offset earlier than earliest qualifies
+        earliest_minutes = -(-(earliest.days * 86400 + earliest.seconds) // 60)
+        if self._is_sorted:
+            i = bisect.bisect_left(self._minutes, earliest_minutes)
+        else:
+            # Skip leading offsets that are too early, as for sorted data
+            i = 0
+            while i < len(self._minutes) and \
+                    self._minutes[i] < earliest_minutes:
+                i += 1
+        if i < len(self._minutes):
+            return self._delays[i]
+        return 0
 
 
 class Trip(object):
-    def __init__(self, trip_id, first_departure_time, last_departure_time):
+    __slots__ = ("trip_id", "start_time_str", "start_time_timedelta",
+                 "start_loc_int", "start_loc_str", "location", "alert",
+                 "offsets", "first_departure_time", "last_departure_time",
+                 "est_scheduled_arrival_earliest",
+                 "est_scheduled_arrival_latest", "usual_delay",
+                 "boarding_stop_id", "_boarding_delay")
+
+    def __init__(self, trip_id, first_departure_time, last_departure_time,
+                 boarding_stop_id=None):
         self.trip_id = trip_id
         self.start_time_str = "unknown"
         self.start_time_timedelta = timedelta.max
@@ -23,11 +110,21 @@ class Trip(object):
         self.start_loc_str = "unknown"
         self.location = "unknown"
         self.alert = None
-        self.offset_tuples = []
+        self.offsets = OffsetTimeline()
         self.first_departure_time = first_departure_time
         self.last_departure_time = last_departure_time
+        # Typical delay for this service, from the history store
+        self.usual_delay = None
+        # Stop id we board at, for looking up transit times in the matrix
+        self.boarding_stop_id = boarding_stop_id
+        self._boarding_delay = None
+
+    @property
+    def offset_tuples(self):
+        return list(self.offsets)
 
     def populate_estimated_arrival_times(self):
+        self._boarding_delay = None
         start_time = self.start_time_timedelta
         if start_time == timedelta.max:
             # There was no delay data available for the vehicle when the
@@ -37,8 +134,11 @@ class Trip(object):
             self.est_scheduled_arrival_earliest = timedelta.max
             self.est_scheduled_arrival_latest = timedelta.max
 
-        if self.start_loc_str in conf.transit_times:
-            min_transit, max_transit = conf.transit_times[self.start_loc_str]
+        transit = transit_times_between(self.start_loc_int,
+                                        self.start_loc_str,
+                                        self.boarding_stop_id)
+        if transit is not None:
+            min_transit, max_transit = transit
             self.est_scheduled_arrival_earliest = start_time + min_transit
             self.est_scheduled_arrival_latest = start_time + max_transit
         else:
@@ -47,9 +147,11 @@ class Trip(object):
             self.est_scheduled_arrival_earliest = timedelta.max
             self.est_scheduled_arrival_latest = timedelta.max
 
-    def is_current(self):
+    def is_current(self, now=None):
         """Arrives at departure station in the future"""
-        return now_as_timedelta() < self.est_scheduled_arrival_latest
+        if now is None:
+            now = now_as_timedelta()
+        return now < self.est_scheduled_arrival_latest
 
     def arrives_in_departure_window(self):
         """Arrives at departure station in the window"""
@@ -62,48 +164,51 @@ class Trip(object):
              self.last_departure_time)
 
     def estimate_delay_at_boarding_station(self):
-        possible_delay_tuples = list(itertools.dropwhile(
-            lambda x: x[0] < self.est_scheduled_arrival_earliest,
-            self.offset_tuples))
-        # The first delay number will be close enough, so let's use that
-        if possible_delay_tuples:
-            return possible_delay_tuples[0][1]
-        else:
-            return 0
+        # The first delay number will be close enough, so let's use that.
+        # The estimated arrival doesn't change once populated, so neither
+        #  does the answer.
+        if self._boarding_delay is None:
+            self._boarding_delay = self.offsets.delay_from(
+                self.est_scheduled_arrival_earliest)
+        return self._boarding_delay
 
     def delay_description(self):
-        estimated_delay = self.estimate_delay_at_boarding_station()
-        if estimated_delay > 0:
-            return "%sm late" % (estimated_delay,)
-        elif estimated_delay < 0:
-            return "%sm early" % (abs(estimated_delay),)
-        else:
-            return "on-time"
+        return describe_delay(self.estimate_delay_at_boarding_station())
 
     def is_running_late(self, lateness_threshold_mins):
         return self.estimate_delay_at_boarding_station() >= \
             lateness_threshold_mins
 
-    def short_summary(self):
-        if not (self.is_current() and self.arrives_in_departure_window()):
-            s = ""
-        else:
-            s = "%s: Scheduled arrival: %s-%s currently at %s (%s from %s)." % \
-                (self.delay_description(),
-                 self.est_scheduled_arrival_earliest,
-                 self.est_scheduled_arrival_latest,
-                 self.location,
-                 self.start_time_str,
-                 self.start_loc_str)
-            if self.alert:
-                s += " Alert: %s" % (self.alert,)
+    def short_summary(self, now=None):
+        if not (self.is_current(now) and self.arrives_in_departure_window()):
+            return ""
+        return self.render_short_summary()
+
+    def render_short_summary(self):
+        """Short summary, for a trip already known to be of interest"""
+        delay = self.delay_description()
+        if self.usual_delay is not None:
+            delay += " (usually %s)" % (describe_delay(self.usual_delay),)
+        s = "%s: Scheduled arrival: %s-%s currently at %s (%s from %s)." % \
+            (delay,
+             self.est_scheduled_arrival_earliest,
+             self.est_scheduled_arrival_latest,
+             self.location,
+             self.start_time_str,
+             self.start_loc_str)
+        if self.alert:
+            s += " Alert: %s" % (self.alert,)
         return s
 
-    def full_summary(self):
+    def full_summary(self, now=None):
+        return self.render_full_summary(self.arrives_in_departure_window(),
+                                        self.is_current(now))
+
+    def render_full_summary(self, arrives_in_departure_window, is_current):
         s = ""
-        if not self.arrives_in_departure_window():
+        if not arrives_in_departure_window:
             s += "[Arrives outside departure window] "
-        if not self.is_current():
+        if not is_current:
             s += "[In the past] "
 
         s += "Trip %s. %s from %s (%s). Currently at %s." \
@@ -118,144 +223,737 @@ class Trip(object):
              self.alert)
         return s
 
+    def status(self, lateness_threshold_mins, now=None):
+        """The trip as a dict of JSON-serialisable values"""
+        def time_or_none(td):
+            return None if td == timedelta.max else str(td)
+        return {"trip_id": self.trip_id,
+                "start_time": self.start_time_str,
+                "origin": self.start_loc_str,
+                "location": self.location,
+                "alert": self.alert,
+                "delay_mins": self.estimate_delay_at_boarding_station(),
+                "usual_delay_mins": self.usual_delay,
+                "arrival_earliest": time_or_none(
+                    self.est_scheduled_arrival_earliest),
+                "arrival_latest": time_or_none(
+                    self.est_scheduled_arrival_latest),
+                "in_departure_window": self.arrives_in_departure_window(),
+                "current": self.is_current(now),
+                "late": self.is_running_late(lateness_threshold_mins)}
+
+
+class TripTable(object):
+    """Column-oriented copy of the trip fields needed to select trips
+
+    Arrival bounds and departure windows are held in parallel arrays
+     (times as seconds since midnight), so that the currency and window
+     checks for every trip are made in one pass against a single "now".
+     Boarding delays are only estimated for the trips those checks select,
+     so the other trips' offsets are never parsed.
+    """
+    # Stands in for timedelta.max, which doesn't fit in an array
+    NO_TIME = 2 ** 31 - 1
+
+    def __init__(self, trips):
+        self.trips = trips
+        self.earliest = array("i", [self.seconds(t.est_scheduled_arrival_earliest)
+                                    for t in trips])
+        self.latest = array("i", [self.seconds(t.est_scheduled_arrival_latest)
+                                  for t in trips])
+        self.window_start = array("i", [self.seconds(t.first_departure_time)
+                                        for t in trips])
+        self.window_end = array("i", [self.seconds(t.last_departure_time)
+                                      for t in trips])
+
+    @classmethod
+    def seconds(cls, td):
+        if td == timedelta.max:
+            return cls.NO_TIME
+        return td.days * 86400 + td.seconds
+
+    def current_mask(self, now):
+        """Arrives at departure station in the future"""
+        now_seconds = self.seconds(now)
+        return [now_seconds < latest for latest in self.latest]
+
+    def in_window_mask(self):
+        """Arrives at departure station in the window"""
+        return [(start < earliest < end) or (start < latest < end)
+                for earliest, latest, start, end in
+                itertools.izip(self.earliest, self.latest,
+                               self.window_start, self.window_end)]
+
+    def late_mask(self, lateness_threshold_mins, selected):
+        """Running late, for the trips in the selected mask"""
+        return [is_selected and t.estimate_delay_at_boarding_station() >=
+                lateness_threshold_mins
+                for t, is_selected in itertools.izip(self.trips, selected)]
+
+
+def transit_times_between(start_loc_int, start_loc_str, boarding_stop_id):
+    """(min, max) transit from a trip's origin to the boarding stop, or None
+
+    The transit matrix is used when there is one, falling back to the
+     hand-maintained conf.transit_times (keyed by origin stop name).
+    """
+    matrix = timetable.get_transit_matrix()
+    if matrix is not None and boarding_stop_id is not None and \
+            start_loc_int >= 0:
+        transit = matrix.transit_times(start_loc_int, boarding_stop_id)
+        if transit is not None:
+            return transit
+    return conf.transit_times.get(start_loc_str)
+
+
+def describe_delay(delay_mins):
+    if delay_mins > 0:
+        return "%sm late" % (delay_mins,)
+    elif delay_mins < 0:
+        return "%sm early" % (abs(delay_mins),)
+    else:
+        return "on-time"
+
 
 def hhmm_string_to_timedelta(s):
     """hh:mm to timedelta"""
     return timedelta(0, 0, 0, 0, *map(int, reversed(s.split(":"))))
 
 
-def now_as_timedelta():
-    n = datetime.now()
+def hhmm_string_to_minutes(s):
+    """hh:mm to minutes since midnight"""
+    hours, _, minutes = s.partition(":")
+    return int(hours) * 60 + int(minutes)
+
+
+def now_as_timedelta(n=None):
+    if n is None:
+        n = datetime.now()
     return timedelta(hours=n.hour, minutes=n.minute)
 
 
-def extract_trip(j, trip_id, fdt, ldt):
-    t = Trip(trip_id, fdt, ldt)
-    delay_data = filter(lambda x: x["tripId"] == trip_id, j["delays"])
+def index_feed(j):
+    """Map tripId to its delay, vehicle and alert records in one pass
+
+    Only the first record seen for each tripId in each section is kept, which
+     matches the behaviour of taking the first element of a filtered list.
+    """
+    index = {}
+    for section, key in (("delays", "delay"),
+                         ("vehicles", "vehicle"),
+                         ("alerts", "alert")):
+        for record in j[section]:
+            entry = index.get(record["tripId"])
+            if entry is None:
+                entry = index[record["tripId"]] = \
+                    {"delay": None, "vehicle": None, "alert": None}
+            if entry[key] is None:
+                entry[key] = record
+    return index
+
+
+def extract_trip(feed_index, trip_id, fdt, ldt, boarding_stop_id=None):
+    t = Trip(trip_id, fdt, ldt, boarding_stop_id)
+    entry = feed_index.get(trip_id, {})
+    delay_data = entry.get("delay")
     #transposition_data = filter(
     #    lambda x: x["tripId"] == trip_id, j["transpositions"])
-    vehicle_data = filter(lambda x: x["tripId"] == trip_id, j["vehicles"])
-    alert_data = filter(lambda x: x["tripId"] == trip_id, j["alerts"])
+    vehicle_data = entry.get("vehicle")
+    alert_data = entry.get("alert")
 
     if delay_data:
-        t.start_time_str = delay_data[0]["start"]
+        t.start_time_str = delay_data["start"]
         # "hh:mm" to timedelta
         t.start_time_timedelta = \
-            hhmm_string_to_timedelta(delay_data[0]["start"])
-        t.start_loc_int = int(delay_data[0]["stopId"])
+            hhmm_string_to_timedelta(delay_data["start"])
+        t.start_loc_int = int(delay_data["stopId"])
         t.start_loc_str = conf.stop_ids.get(
             t.start_loc_int, "Unknown")
-        # offsets is a string of comma sep list of alternating times and delays
-        # e.g. "14:15,16,17:10,14,17:42,13,18:25,11,19:57,10,20:20,9"
-        # Convert to list of tuples of datetime.timedelta & delay as int
-        #
         # Sometimes offsets is not present in the delay data
-        if "offsets" in delay_data[0]:
-            offsets_raw_list = delay_data[0]["offsets"].split(",")
-        else:
-            offsets_raw_list = []
-        t.offset_tuples = zip(
-            [hhmm_string_to_timedelta(x)
-             for x in (itertools.islice(offsets_raw_list, 0, None, 2))],
-            map(int, itertools.islice(offsets_raw_list, 1, None, 2))
-        )
+        t.offsets = OffsetTimeline(delay_data.get("offsets", ""))
 
     if vehicle_data:
-        t.location = vehicle_data[0]["lp"].rsplit(":", 2)[0]
+        t.location = vehicle_data["lp"].rsplit(":", 2)[0]
     if alert_data:
-        if "body" in alert_data[0]:
-            t.alert = alert_data[0]["body"]
+        if "body" in alert_data:
+            t.alert = alert_data["body"]
         else:
-            t.alert = alert_data[0]["title"]
+            t.alert = alert_data["title"]
 
     t.populate_estimated_arrival_times()
     return t
 
 
-def main(fdt, ldt, lateness_threshold_mins, send_notification, no_lights):
-    r = requests.get(BASE_URL % (conf.ROUTES,))
-    j = r.json()
+class BackgroundTask(threading.Thread):
+    """Runs a function in a daemon thread and keeps its result and duration
 
-    logging.debug("Retrieved at: %s",
-                  datetime.fromtimestamp(j["timestamp"]).ctime())
-    # Save the realtime data for troubleshooting and verification
-    logging.debug("JSON data follows:")
-    logging.debug(r.text)
+    result() waits for the function to finish and returns its value, or
+     re-raises whatever exception it raised.
+    """
+    def __init__(self, name, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.duration = None
+        self._result = None
+        self._exc_info = None
+        super(BackgroundTask, self).__init__(name=name)
+        self.daemon = True
+
+    def run(self):
+        start = time.time()
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        finally:
+            self.duration = time.time() - start
+
+    def result(self):
+        self.join()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class LiveBackends(object):
+    """The real clock, locator, Hue bridge and Pushover outbox"""
+    def now(self):
+        return now_as_timedelta()
+
+    def locate(self):
+        return locator.cached_locate(conf.ADDRESS_NAME_PAIR_LISTS,
+                                     conf.LOCATION_PING_PERIOD_SECS)
+
+    def connect_lights(self):
+        return notifier.get_light_controller().connect()
 
-    logging.debug("Looking for arrivals between %s and %s", fdt, ldt)
+    def set_lights(self, lateness_by_light_name):
+        return notifier.set_lamp_states(lateness_by_light_name)
+
+    def queue_notification(self, title, message, trip_ids, device,
+                           dedup_content, force):
+        return outbox.get_outbox().enqueue(title, message, trip_ids, device,
+                                           dedup_content, force)
+
+    def flush_notifications(self):
+        return outbox.get_outbox().flush()
+
+
+class Subscription(object):
+    """A subscriber's interest in one route during one departure window"""
+    def __init__(self, route, first_departure_time, last_departure_time,
+                 lateness_threshold_mins=DEFAULT_LATENESS_THRESHOLD_MINS,
+                 device=None, light_name=None, notification_locations=None,
+                 name=None, boarding_stop_id=None):
+        self.route = route
+        self.first_departure_time = first_departure_time
+        self.last_departure_time = last_departure_time
+        self.lateness_threshold_mins = lateness_threshold_mins
+        # Pushover device name. None sends to all of the user's devices
+        self.device = device
+        # Hue light to set. None leaves the lights alone
+        self.light_name = light_name
+        if notification_locations is None:
+            notification_locations = conf.NOTIFICATION_LOCATIONS
+        self.notification_locations = notification_locations
+        self.name = name or route
+        if boarding_stop_id is None:
+            boarding_stop_id = getattr(conf, "BOARDING_STOP_ID", None)
+        self.boarding_stop_id = boarding_stop_id
+
+    def __repr__(self):
+        return "<Subscription %s: %s %s-%s>" % \
+            (self.name, self.route,
+             self.first_departure_time, self.last_departure_time)
+
+
+def subscriptions_from_conf(subscription_dicts, now=None):
+    """Build Subscriptions from dicts, as found in conf.SUBSCRIPTIONS
+
+    Each dict must have a "route" and may have "first_departure_time" and
+     "last_departure_time" (as hh:mm), "lateness_threshold_mins", "device",
+     "light_name", "notification_locations", "name" and "boarding_stop_id".
+    """
+    subscriptions = []
+    for d in subscription_dicts:
+        fdt, ldt = departure_window(d.get("first_departure_time"),
+                                    d.get("last_departure_time"), now)
+        subscriptions.append(Subscription(
+            d["route"], fdt, ldt,
+            d.get("lateness_threshold_mins", DEFAULT_LATENESS_THRESHOLD_MINS),
+            device=d.get("device"),
+            light_name=d.get("light_name"),
+            notification_locations=d.get("notification_locations"),
+            name=d.get("name"),
+            boarding_stop_id=d.get("boarding_stop_id")))
+    return subscriptions
+
+
+def feed_url(routes):
+    return BASE_URL % (",".join(routes),)
+
+
+def routes_for(subscriptions):
+    return sorted(set(s.route for s in subscriptions))
+
+
+def trip_ids_by_route(j, routes):
+    """tripIds of vehicles on each of the given routes, in feed order"""
     # Trains only appear in the vehicles list once they have actually departed.
     # Trains that are past their departure time ("start") but have not left
     #  their origin are not listed in vehicles until they've actually left
     #  the station.
-    trips = []
-    for tripId in [v["tripId"] for v in j["vehicles"]
-                   if v["route"] == conf.ROUTES]:
-        trips.append(extract_trip(j, tripId, fdt, ldt))
+    trip_ids = dict((route, []) for route in routes)
+    for v in j["vehicles"]:
+        if v["route"] in trip_ids:
+            trip_ids[v["route"]].append(v["tripId"])
+    return trip_ids
+
+
+def evaluate_trips(trips, lateness_threshold_mins, now=None,
+                   full_summaries=True):
+    """Returns notification, short and full summary lines and late trip ids
+
+    Trips are selected with TripTable and only the selected ones have short
+     summaries rendered. Full summaries (of every trip) are only rendered if
+     full_summaries is set.
+    """
+    if now is None:
+        now = now_as_timedelta()
+    table = TripTable(trips)
+    current = table.current_mask(now)
+    in_window = table.in_window_mask()
+    selected = [is_current and arrives_in_window for is_current,
+                arrives_in_window in itertools.izip(current, in_window)]
+    late = table.late_mask(lateness_threshold_mins, selected)
 
     notification_lines = []
     short_summary_lines = []
     full_summary_lines = []
-    trains_are_running_late = False
-    for t in trips:
-        if t.is_current() and t.arrives_in_departure_window():
-            if t.is_running_late(lateness_threshold_mins):
-                trains_are_running_late = True
-                notification_lines.append(t.short_summary())
-            short_summary_lines.append(t.short_summary())
-            full_summary_lines.append(t.full_summary())
-        else:
-            full_summary_lines.append(t.full_summary())
+    late_trip_ids = []
+    for t, is_current, arrives_in_window, is_selected, is_late in \
+            itertools.izip(trips, current, in_window, selected, late):
+        if is_selected:
+            short_summary = t.render_short_summary()
+            if is_late:
+                late_trip_ids.append(t.trip_id)
+                notification_lines.append(short_summary)
+            short_summary_lines.append(short_summary)
+        if full_summaries:
+            full_summary_lines.append(
+                t.render_full_summary(arrives_in_window, is_current))
+    return notification_lines, short_summary_lines, full_summary_lines, \
+        late_trip_ids
 
-    if len(notification_lines) == 0:
-        notification_subject = "All trains on time"
-    elif len(notification_lines) == 1:
-        notification_subject = "1 train running late"
+
+def notification_subject_for(late_train_count):
+    if late_train_count == 0:
+        return "All trains on time"
+    elif late_train_count == 1:
+        return "1 train running late"
     else:
-        notification_subject = "%s trains running late" % \
-                               (len(notification_lines),)
+        return "%s trains running late" % (late_train_count,)
+
+
+def log_light_set_status(light_set_status):
+    if light_set_status == notifier.LIGHT_SET_OK:
+        logging.debug("Light operations successful")
+    elif light_set_status == notifier.LIGHT_SET_FAILED_BRIDGE_COMMS:
+        logging.error("Unable to perform light operations -"
+                      " timeout to bridge")
+    elif light_set_status == notifier.LIGHT_SET_FAILED_NOT_REGISTERED:
+        logging.error("Unable to perform light operations -"
+                      " application not registered with bridge."
+                      " Press bridge button and try again.")
+    elif light_set_status == notifier.LIGHT_SET_FAILED_UNKNOWN_LIGHT:
+        logging.error("Unable to perform light operations -"
+                      " no light or group with that name on the bridge")
+    else:
+        logging.error("Unknown return code from set lamp state: %s",
+                      light_set_status)
+
+
+def notify_subscriber(subscription, trips, retrieved_at,
+                      notification_device_location, send_notification,
+                      backends, now, evaluation=None):
+    """Send the subscriber's notification. Returns whether trains are late
 
-    logging.info(notification_subject)
-    notification_lines.append("Retrieved at: %s" %
-                              (datetime.fromtimestamp(j["timestamp"]).ctime(),))
+    evaluation is the result of evaluate_trips for trips, if the caller
+     already has it.
+    """
+    logging.debug("%s: looking for arrivals between %s and %s",
+                  subscription.name, subscription.first_departure_time,
+                  subscription.last_departure_time)
+    if evaluation is None:
+        evaluation = evaluate_trips(
+            trips, subscription.lateness_threshold_mins, now,
+            full_summaries=logging.getLogger().isEnabledFor(logging.DEBUG))
+    # Copied, as the notification lines are added to below
+    notification_lines = list(evaluation[0])
+    short_summary_lines, full_summary_lines, late_trip_ids = evaluation[1:]
+    trains_are_running_late = bool(late_trip_ids)
+
+    notification_subject = notification_subject_for(len(notification_lines))
+    logging.info("%s: %s", subscription.name, notification_subject)
+    notification_lines.append("Retrieved at: %s" % (retrieved_at,))
     notification_message = "\n".join(notification_lines)
 
-    notification_device_location = locator.locate(
-        conf.ADDRESS_NAME_PAIR_LISTS,
-        conf.LOCATION_PING_PERIOD_SECS)
     if send_notification == SEND_NOTIFICATION_ALWAYS or \
             (send_notification != SEND_NOTIFICATION_NEVER and
              trains_are_running_late and
-             notification_device_location in conf.NOTIFICATION_LOCATIONS):
-        logging.info("Sending pushover notification. Subject: %s",
+             notification_device_location in
+             subscription.notification_locations):
+        logging.info("Queueing pushover notification. Subject: %s",
                      notification_subject)
         logging.info("Notification message: %s", notification_message)
-        request = notifier.send_pushover_notification(notification_message,
-                                                      notification_subject)
-        logging.debug("Request is %s", request)
+        # The summaries change as trains move, so repeats are identified by
+        #  the subject and the trips it's about
+        backends.queue_notification(
+            notification_subject, notification_message, late_trip_ids,
+            subscription.device, dedup_content=notification_subject,
+            force=send_notification == SEND_NOTIFICATION_ALWAYS)
+        metrics.increment("notifications_queued")
     else:
         logging.info("Not sending pushover notification")
 
-    if not no_lights:
-        light_set_status = notifier.set_lamp_state(trains_are_running_late)
-        if light_set_status == notifier.LIGHT_SET_OK:
-            logging.debug("Light operations successful")
-        elif light_set_status == notifier.LIGHT_SET_FAILED_BRIDGE_COMMS:
-            logging.error("Unable to perform light operations -"
-                          " timeout to bridge")
-        elif light_set_status == notifier.LIGHT_SET_FAILED_NOT_REGISTERED:
-            logging.error("Unable to perform light operations -"
-                          " application not registered with bridge."
-                          " Press bridge button and try again.")
-        else:
-            logging.error("Unknown return code from set lamp state: %s",
-                          light_set_status)
-    else:
-        logging.debug("Not turning on lights because --no_lights cmdline param")
-
     logging.debug("--- Short summary start ---")
     logging.debug(short_summary_lines)
     logging.debug("--- Full summary start ---")
     logging.debug(full_summary_lines)
+    return trains_are_running_late
+
+
+def subscription_status(subscription, trips, evaluation, now):
+    """What's published to the status server for one subscription"""
+    notification_lines, short_summary_lines, full_summary_lines, \
+        late_trip_ids = evaluation
+    return {"name": subscription.name,
+            "route": subscription.route,
+            "first_departure_time": str(subscription.first_departure_time),
+            "last_departure_time": str(subscription.last_departure_time),
+            "lateness_threshold_mins": subscription.lateness_threshold_mins,
+            "light_name": subscription.light_name,
+            "late": bool(late_trip_ids),
+            "subject": notification_subject_for(len(notification_lines)),
+            "short_summary": short_summary_lines,
+            "full_summary": full_summary_lines,
+            "trips": [t.status(subscription.lateness_threshold_mins, now)
+                      for t in trips]}
+
+
+def run_subscriptions(subscriptions, send_notification, no_lights,
+                      fetcher=None, backends=None, record_dir=None,
+                      history_store=None, status_board=None):
+    """Evaluate every subscription against a single fetch of the feed
+
+    Locating the device and connecting to the Hue bridge don't depend on the
+     feed, so they start first and run while the feed is downloaded. If
+     record_dir is given, the feed is saved there for later replay. If
+     history_store is given, summaries include each service's usual delay
+     and the trips are added to the store. If status_board is given, the
+     summaries, trips, location and light state are published to it.
+    """
+    run_start = time.time()
+    metrics.increment("runs")
+    if backends is None:
+        backends = LiveBackends()
+    locate_task = BackgroundTask("locate", backends.locate)
+    locate_task.start()
+    needs_bridge = not no_lights and \
+        any(s.light_name is not None for s in subscriptions)
+    bridge_task = BackgroundTask("bridge", backends.connect_lights)
+    if needs_bridge:
+        bridge_task.start()
+
+    routes = routes_for(subscriptions)
+    if fetcher is None:
+        fetcher = feed.FeedFetcher(feed_url(routes))
+    fetch_start = time.time()
+    j = fetcher.fetch()
+    fetch_duration = time.time() - fetch_start
+
+    retrieved_at = datetime.fromtimestamp(j["timestamp"]).ctime()
+    logging.debug("Retrieved at: %s", retrieved_at)
+    # Save the realtime data for troubleshooting and verification
+    if fetcher.text is not None:
+        logging.debug("JSON data follows:")
+        logging.debug(fetcher.text)
+        if record_dir:
+            replay.record_snapshot(fetcher.text, j["timestamp"], record_dir)
+    elif getattr(fetcher, "spill_path", None):
+        logging.debug("JSON data saved to %s", fetcher.spill_path)
+        if record_dir:
+            replay.record_snapshot_file(fetcher.spill_path, j["timestamp"],
+                                        record_dir)
+
+    metrics.increment("feed_records",
+                      sum(len(j[section]) for section in feed.RECORD_SECTIONS))
+    now = backends.now()
+    feed_index = index_feed(j)
+    route_trip_ids = trip_ids_by_route(j, routes)
+
+    notification_device_location = locate_task.result()
+
+    weekday = datetime.fromtimestamp(j["timestamp"]).weekday()
+    trips_to_record = {}
+    lateness_by_light_name = {}
+    subscription_statuses = []
+    full_summaries = status_board is not None or \
+        logging.getLogger().isEnabledFor(logging.DEBUG)
+    for subscription in subscriptions:
+        trips = [extract_trip(feed_index, trip_id,
+                              subscription.first_departure_time,
+                              subscription.last_departure_time,
+                              subscription.boarding_stop_id)
+                 for trip_id in route_trip_ids[subscription.route]]
+        if history_store is not None:
+            try:
+                for t in trips:
+                    t.usual_delay = history_store.usual_delay(t, weekday)
+                    # Each subscriber's boarding stop has its own delay
+                    trips_to_record.setdefault(
+                        (t.trip_id, t.boarding_stop_id), t)
+            except history_store.Error:
+                logging.exception("Unable to read delay history")
+        with metrics.timer("evaluate"):
+            evaluation = evaluate_trips(trips,
+                                        subscription.lateness_threshold_mins,
+                                        now, full_summaries=full_summaries)
+        metrics.increment("trips", len(trips))
+        metrics.increment("late_trips", len(evaluation[3]))
+        trains_are_running_late = notify_subscriber(
+            subscription, trips, retrieved_at, notification_device_location,
+            send_notification, backends, now, evaluation)
+        if status_board is not None:
+            subscription_statuses.append(
+                subscription_status(subscription, trips, evaluation, now))
+        if subscription.light_name is not None:
+            # A light shared by several subscribers shows red if any of
+            #  them has a late train
+            lateness_by_light_name[subscription.light_name] = \
+                lateness_by_light_name.get(subscription.light_name) or \
+                trains_are_running_late
+
+    if history_store is not None:
+        try:
+            history_store.record(trips_to_record.values(), j["timestamp"])
+        except history_store.Error:
+            logging.exception("Unable to record delay history")
+
+    stage_timings = [("fetch", fetch_duration),
+                     ("locate", locate_task.duration)]
+    light_set_status = None
+    if no_lights:
+        logging.debug("Not turning on lights because --no_lights cmdline param")
+    elif not lateness_by_light_name:
+        logging.debug("Not turning on lights because no subscriber has one")
+    else:
+        light_set_status = bridge_task.result()
+        stage_timings.append(("bridge", bridge_task.duration))
+        if light_set_status == notifier.LIGHT_SET_OK:
+            lights_start = time.time()
+            light_set_status = backends.set_lights(lateness_by_light_name)
+            stage_timings.append(("lights", time.time() - lights_start))
+        log_light_set_status(light_set_status)
+
+    if status_board is not None:
+        status_board.publish({
+            "retrieved_at": retrieved_at,
+            "feed_timestamp": j["timestamp"],
+            "location": notification_device_location,
+            "lights": lateness_by_light_name,
+            "lights_set": None if light_set_status is None
+            else light_set_status == notifier.LIGHT_SET_OK,
+            "subscriptions": subscription_statuses})
+    stage_timings.append(("total", time.time() - run_start))
+    for stage, duration in stage_timings:
+        metrics.record_duration(stage, duration)
+    logging.info("Stage timings: %s",
+                 ", ".join("%s %.2fs" % t for t in stage_timings))
+
+
+def main(fdt, ldt, lateness_threshold_mins, send_notification, no_lights,
+         fetcher=None, backends=None):
+    if backends is None:
+        backends = LiveBackends()
+    subscription = Subscription(conf.ROUTES, fdt, ldt, lateness_threshold_mins,
+                                light_name=conf.HUE_LIGHT_NAME)
+    run_subscriptions([subscription], send_notification, no_lights, fetcher,
+                      backends)
+    backends.flush_notifications()
+
+
+def departure_window(first_departure_time_str, last_departure_time_str,
+                     now=None):
+    """Departure window as timedeltas, defaulting to the next 60 minutes"""
+    if now is None:
+        now = now_as_timedelta()
+    if first_departure_time_str:
+        first_departure_time = \
+            hhmm_string_to_timedelta(first_departure_time_str)
+    else:
+        first_departure_time = now
+    if last_departure_time_str:
+        last_departure_time = \
+            hhmm_string_to_timedelta(last_departure_time_str)
+    else:
+        last_departure_time = now + timedelta(minutes=60)
+    return first_departure_time, last_departure_time
+
+
+def subscriptions_from_args(args, now=None):
+    if args.subscriptions:
+        return subscriptions_from_conf(conf.SUBSCRIPTIONS, now)
+    fdt, ldt = departure_window(args.first_departure_time,
+                                args.last_departure_time, now)
+    return [Subscription(conf.ROUTES, fdt, ldt, args.lateness_threshold_mins,
+                         light_name=conf.HUE_LIGHT_NAME)]
+
+
+def fetcher_from_args(args):
+    routes = routes_for(subscriptions_from_args(args))
+    return feed.FeedFetcher(feed_url(routes), streaming=args.stream,
+                            routes=routes, spill_path=args.stream_spill_file)
+
+
+def history_store_from_args(args):
+    if args.history_db:
+        import history
+        return history.HistoryStore(args.history_db)
+    return None
+
+
+def flush_history(history_store):
+    """Write a run's buffered snapshots, so long-running modes don't hold
+     them in memory until the batch fills
+    """
+    if history_store is None:
+        return
+    try:
+        history_store.flush()
+    except history_store.Error:
+        logging.exception("Unable to record delay history")
+
+
+def call_profiled(profile_path, f, *args, **kwargs):
+    """Call f, saving a cProfile of the call to profile_path if it's set"""
+    if not profile_path:
+        return f(*args, **kwargs)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(f, *args, **kwargs)
+    finally:
+        profiler.dump_stats(profile_path)
+        logging.info("Profile saved to %s", profile_path)
+
+
+def write_metrics(args):
+    if not args.metrics_file:
+        return
+    try:
+        metrics.get_registry().write(args.metrics_file, args.metrics_format)
+    except EnvironmentError as e:
+        logging.error("Unable to write metrics to %s: %s",
+                      args.metrics_file, e)
+
+
+def run_daemon(args, interval):
+    """Run the notification pipeline every interval seconds
+
+    The feed fetcher is kept for the life of the process so that the HTTP
+     connection is pooled and unchanged feeds are not re-parsed. With
+     --status-port (or conf.STATUS_PORT), each run's results are also
+     served over HTTP.
+    """
+    fetcher = fetcher_from_args(args)
+    history_store = history_store_from_args(args)
+    status_board = None
+    status_port = args.status_port or getattr(conf, "STATUS_PORT", None)
+    if status_port:
+        import status_server
+        status_board = status_server.StatusBoard()
+        status_server.start_status_server(status_board, args.status_host,
+                                          status_port)
+    while True:
+        run_start = time.time()
+        # Recalculate each time so that a default window follows the clock
+        subscriptions = subscriptions_from_args(args)
+        try:
+            call_profiled(args.profile, run_subscriptions,
+                          subscriptions,
+                          args.send_notification,
+                          args.no_lights,
+                          fetcher=fetcher,
+                          record_dir=args.record_dir,
+                          history_store=history_store,
+                          status_board=status_board)
+        except feed.FeedUnavailable as e:
+            metrics.increment("run_failures")
+            logging.error("%s", e)
+        except Exception:
+            metrics.increment("run_failures")
+            logging.exception("Notification run failed")
+        flush_history(history_store)
+        write_metrics(args)
+        run_duration = time.time() - run_start
+        time.sleep(max(0, interval - run_duration))
+
+
+def run_on_arrival(args):
+    """Run the pipeline whenever the device arrives somewhere a subscriber
+     is notified, rather than on a timer
+
+    Arrivals come from locator's debounced location change events, which
+     also keep the location cache fresh for the run's own locate.
+    """
+    fetcher = fetcher_from_args(args)
+    history_store = history_store_from_args(args)
+
+    def check_trains_on_arrival(change):
+        subscriptions = subscriptions_from_args(args)
+        if not any(change.current in s.notification_locations
+                   for s in subscriptions):
+            return
+        logging.info("%s - checking trains", change.describe())
+        call_profiled(args.profile, run_subscriptions,
+                      subscriptions,
+                      args.send_notification,
+                      args.no_lights,
+                      fetcher=fetcher,
+                      record_dir=args.record_dir,
+                      history_store=history_store)
+        flush_history(history_store)
+        write_metrics(args)
+
+    locator.report_location_changes(
+        conf.ADDRESS_NAME_PAIR_LISTS, conf.LOCATION_PING_PERIOD_SECS,
+        passive=args.passive_location, subscribers=[check_trains_on_arrival])
+
+
+def run_replay(args, path):
+    """Run the pipeline over recorded snapshots with stubbed backends
+
+    Each snapshot is evaluated as at the time it was retrieved.
+    """
+    location = args.replay_location or conf.NOTIFICATION_LOCATIONS[0]
+    for snapshot_path in replay.snapshot_paths(path):
+        fetcher = replay.ReplayFetcher(snapshot_path)
+        retrieved = datetime.fromtimestamp(fetcher.fetch()["timestamp"])
+        backends = replay.StubBackends(location, now_as_timedelta(retrieved))
+        logging.info("Replaying %s (retrieved at %s)",
+                     snapshot_path, retrieved.ctime())
+        run_subscriptions(subscriptions_from_args(args, backends.now()),
+                          args.send_notification,
+                          args.no_lights,
+                          fetcher=fetcher,
+                          backends=backends)
+        for title, message, device in backends.notifications:
+            logging.info("Would notify %s: %s\n%s",
+                         device or "all devices", title, message)
+        for lateness_by_light_name in backends.light_states:
+            logging.info("Would set lights: %s", lateness_by_light_name)
 
 
 if __name__ == "__main__":
@@ -271,18 +969,66 @@ if __name__ == "__main__":
                                  SEND_NOTIFICATION_AUTO,
                                  SEND_NOTIFICATION_NEVER])
     parser.add_argument("--no_lights", action="store_true", default=False)
+    parser.add_argument("--subscriptions", action="store_true", default=False,
+                        help="Evaluate every entry in conf.SUBSCRIPTIONS "
+                             "instead of the departure time arguments")
+    parser.add_argument("--daemon", action="store_true", default=False,
+                        help="Keep running, checking every --interval secs")
+    parser.add_argument("--on-arrival", action="store_true", default=False,
+                        help="Keep running, checking whenever the device "
+                             "arrives at one of the notification locations")
+    parser.add_argument("--passive-location", action="store_true",
+                        default=False,
+                        help="With --on-arrival, watch the kernel neighbor "
+                             "table instead of probing")
+    parser.add_argument("--interval", type=int,
+                        default=DEFAULT_DAEMON_INTERVAL_SECS,
+                        help="Seconds between checks in --daemon mode")
+    parser.add_argument("--stream", action="store_true", default=False,
+                        help="Parse the feed as it downloads, keeping only "
+                             "records for the routes we're interested in")
+    parser.add_argument("--stream-spill-file",
+                        default=getattr(conf, "FEED_SPILL_FILE", None),
+                        help="With --stream, save the raw feed to this file")
+    parser.add_argument("--record-dir",
+                        default=getattr(conf, "SNAPSHOT_DIR", None),
+                        help="Save each retrieved feed in this directory")
+    parser.add_argument("--history-db",
+                        default=getattr(conf, "HISTORY_DB", None),
+                        help="sqlite database of past delays, used to show "
+                             "each service's usual delay and updated with "
+                             "this run's")
+    # conf.STATUS_PORT only applies in --daemon mode, so that setting it
+    #  doesn't turn one-shot runs into daemons
+    parser.add_argument("--status-port", type=int,
+                        help="Serve each check's results on this port "
+                             "(implies --daemon). Defaults to "
+                             "conf.STATUS_PORT in --daemon mode")
+    parser.add_argument("--status-host",
+                        default=getattr(conf, "STATUS_HOST", ""),
+                        help="Address for --status-port to listen on")
+    parser.add_argument("--metrics-file",
+                        default=getattr(conf, "METRICS_FILE", None),
+                        help="Write stage timings and counters to this file "
+                             "after each run")
+    parser.add_argument("--metrics-format",
+                        default=getattr(conf, "METRICS_FORMAT",
+                                        metrics.FORMAT_PROMETHEUS),
+                        choices=[metrics.FORMAT_PROMETHEUS,
+                                 metrics.FORMAT_JSON],
+                        help="Prometheus text file (rewritten each run) or "
+                             "JSON lines (appended each run)")
+    parser.add_argument("--profile",
+                        help="Save a cProfile of the run to this file (the "
+                             "latest run, in --daemon mode)")
+    parser.add_argument("--replay",
+                        help="Evaluate a recorded feed snapshot (or a "
+                             "directory of them) without contacting the "
+                             "device, bridge or Pushover")
+    parser.add_argument("--replay-location",
+                        help="Device location to assume when replaying")
     parser.add_argument("--verbose", "-v", action="count")
     args = parser.parse_args()
-    if args.first_departure_time:
-        first_departure_time = \
-            hhmm_string_to_timedelta(args.first_departure_time)
-    else:
-        first_departure_time = now_as_timedelta()
-    if args.last_departure_time:
-        last_departure_time = \
-            hhmm_string_to_timedelta(args.last_departure_time)
-    else:
-        last_departure_time = now_as_timedelta() + timedelta(minutes=60)
 
     # Optionally log to disk instead of stdout
     logfile = getattr(conf, "LOGFILE", None)
@@ -294,8 +1040,25 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.DEBUG, filename=logfile)
 
-    main(first_departure_time,
-         last_departure_time,
-         args.lateness_threshold_mins,
-         args.send_notification,
-         args.no_lights)
+    if args.replay:
+        call_profiled(args.profile, run_replay, args, args.replay)
+        write_metrics(args)
+    elif args.on_arrival:
+        run_on_arrival(args)
+    elif args.daemon or args.status_port:
+        run_daemon(args, args.interval)
+    else:
+        history_store = history_store_from_args(args)
+        call_profiled(args.profile, run_subscriptions,
+                      subscriptions_from_args(args),
+                      args.send_notification,
+                      args.no_lights,
+                      fetcher=fetcher_from_args(args),
+                      record_dir=args.record_dir,
+                      history_store=history_store)
+        if history_store is not None:
+            history_store.close()
+        # Notifications are sent in the background while the lights are set
+        if not outbox.get_outbox().flush():
+            logging.error("Timed out waiting for notifications to be sent")
+        write_metrics(args)
@@ -1,8 +1,16 @@
-import requests
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
 import conf
-import urllib2
-import xml.etree.ElementTree as ET
-import io
+import metrics
+
+DEFAULT_TIMEOUT_SECS = 10
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "bom-cache")
+MIN_TEMP_ELEMENT_TYPE = "air_temperature_minimum"
 
 
 def get_min_temp_phrase_from_values(min_observed, min_forecast):
@@ -28,32 +36,232 @@ def get_min_temp_phrase_from_values(min_observed, min_forecast):
     return s
 
 
-def get_min_observed_and_forecasted(bom_obs_url, bom_forecast_url, bom_forecast_area):
+def cache_dir():
+    return getattr(conf, "BOM_CACHE_DIR", DEFAULT_CACHE_DIR)
+
+
+def write_atomically(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    except EnvironmentError:
+        os.unlink(tmp_path)
+        raise
+
+
+class CachedProduct(object):
+    """A BOM product kept on disk, and only downloaded again when it changes
+
+    Each fetch is a conditional GET using the ETag or Last-Modified of the
+     cached copy. Values extracted from the product are kept alongside it
+     in meta, keyed on the product's issue time, so a product that's been
+     re-served unchanged isn't parsed again. If a download fails the cached
+     copy is used.
+    """
+    def __init__(self, url, directory=None):
+        self.url = url
+        directory = directory or cache_dir()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = hashlib.sha1(url).hexdigest()
+        self.body_path = os.path.join(directory, name + ".body")
+        self.meta_path = os.path.join(directory, name + ".json")
+        try:
+            with open(self.meta_path) as f:
+                self.meta = json.load(f)
+        except (EnvironmentError, ValueError):
+            self.meta = {}
+        if not os.path.exists(self.body_path):
+            self.meta = {}
+
+    def conditional_headers(self):
+        headers = {}
+        if self.meta.get("etag"):
+            headers["If-None-Match"] = self.meta["etag"]
+        if self.meta.get("last_modified"):
+            headers["If-Modified-Since"] = self.meta["last_modified"]
+        return headers
+
+    def fetch(self, session, timeout=DEFAULT_TIMEOUT_SECS):
+        """Bring the cached copy up to date. Returns whether it changed"""
+        import requests
+        try:
+            r = session.get(self.url, headers=self.conditional_headers(),
+                            timeout=timeout, stream=True)
+            if r.status_code == 304:
+                logging.debug("%s not modified", self.url)
+                metrics.increment("bom_not_modified")
+                return False
+            r.raise_for_status()
+            # Streamed to disk, so the product is never held in memory
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.body_path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                os.rename(tmp_path, self.body_path)
+            except Exception:
+                # Don't leave a partial download behind in the cache
+                os.unlink(tmp_path)
+                raise
+        except requests.RequestException as e:
+            if not self.meta:
+                raise
+            logging.warning("Unable to fetch %s (%s) - using cached copy",
+                            self.url, e)
+            return False
+        self.meta["etag"] = r.headers.get("etag")
+        self.meta["last_modified"] = r.headers.get("last-modified")
+        return True
+
+    def save_meta(self):
+        write_atomically(self.meta_path, json.dumps(self.meta))
+
+
+def extract_min_forecasts(forecast_file, areas):
+    """(issue time, {aac: tomorrow's forecast minimum}) from a state precis
+     forecast
+
+    The forecast is parsed as a stream, only the requested areas are looked
+     at, and parsing stops as soon as they've all been found. Areas without
+     a minimum temperature forecast map to None.
+    """
+    try:
+        import xml.etree.cElementTree as ET
+    except ImportError:
+        import xml.etree.ElementTree as ET
+    wanted = set(areas)
+    minimums = {}
+    issue_time = None
+    current_area = None
+    for event, elem in ET.iterparse(forecast_file, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "area":
+                aac = elem.get("aac")
+                current_area = aac if aac in wanted else None
+            continue
+        if elem.tag == "issue-time-utc":
+            issue_time = elem.text
+            if not wanted:
+                break
+        elif elem.tag == "element" and current_area is not None and \
+                elem.get("type") == MIN_TEMP_ELEMENT_TYPE and \
+                minimums.get(current_area) is None:
+            # The first minimum reading. The current day will not have a
+            #  minimum reading so this corresponds to tomorrow's minimum
+            #  forecast temperature
+            minimums[current_area] = int(elem.text)
+        elif elem.tag == "area":
+            if current_area is not None:
+                minimums.setdefault(current_area, None)
+                wanted.discard(current_area)
+                if not wanted:
+                    break
+            current_area = None
+            # Nothing more is needed from the area, so free it
+            elem.clear()
+    for aac in wanted:
+        minimums.setdefault(aac, None)
+    return issue_time, minimums
+
+
+def get_min_forecasts(forecast_url, areas, session):
+    """{aac: tomorrow's forecast minimum} from the state precis forecast
+
+    State forecast URLs are in XML format and are accessible from
+     http://www.bom.gov.au/info/precis_forecasts.shtml
+    """
+    product = CachedProduct(forecast_url)
+    with metrics.timer("bom_forecast"):
+        changed = product.fetch(session)
+    if changed:
+        with open(product.body_path, "rb") as f:
+            issue_time = extract_min_forecasts(f, ())[0]
+        if issue_time != product.meta.get("issue_time"):
+            product.meta["issue_time"] = issue_time
+            product.meta["minimums"] = {}
+    cached = product.meta.setdefault("minimums", {})
+    missing = [aac for aac in areas if aac not in cached]
+    if missing:
+        with metrics.timer("bom_forecast_parse"):
+            with open(product.body_path, "rb") as f:
+                cached.update(extract_min_forecasts(f, missing)[1])
+    if changed or missing:
+        product.save_meta()
+    return dict((aac, cached[aac]) for aac in areas)
+
+
+def get_min_observed(bom_obs_url, session):
     # BOM observation data is available for several weather stations, and
     #  in several formats (including the JSON that we use here).
     #  e.g. http://www.bom.gov.au/products/IDN60901/IDN60901.94768.shtml
-    r = requests.get(bom_obs_url)
+    with metrics.timer("bom_observations"):
+        r = session.get(bom_obs_url, timeout=DEFAULT_TIMEOUT_SECS)
+        r.raise_for_status()
     # this will only be used in the late afternoon and
     # min reading is usually about 5am on the same day.
     # Comes as a float, so let's round and cast
-    min_obs = int(round(min([reading["air_temp"] for reading
-                  in r.json()["observations"]["data"]])))
-
-    # State forecast URLs are in XML format and are accessible from
-    # http://www.bom.gov.au/info/precis_forecasts.shtml
-    f = urllib2.urlopen(bom_forecast_url)
-    forecast_report = io.StringIO(unicode(f.read()))
-    tree = ET.parse(forecast_report)
-    # Get the first (zeroth) minimum air temperature reading.
-    # The current day will not have a minimum reading so this corresponds
-    #  to tomorrow's minimum forecast temperature
-    min_forecast = int(
-        tree.findall("./forecast"
-                     "/area[@aac='%s']"
-                     "/forecast-period"
-                     "/element[@type='air_temperature_minimum']" %
-                     (bom_forecast_area,))[0].text)
-    return min_obs, min_forecast
+    return int(round(min([reading["air_temp"] for reading
+                          in r.json()["observations"]["data"]])))
+
+
+def get_min_observed_and_forecasted_batch(bom_forecast_url,
+                                          obs_urls_by_area):
+    """{aac: (min observed, min forecast)} for each area in obs_urls_by_area
+
+    The forecast is fetched and parsed once for all the areas, while the
+     observations for each area are fetched in parallel with it. Areas with
+     no minimum in the forecast are left out.
+    """
+    import requests
+    session = requests.Session()
+    results = {}
+    errors = []
+
+    def run(key, f, *args):
+        try:
+            results[key] = f(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(
+        "forecast", get_min_forecasts, bom_forecast_url,
+        list(obs_urls_by_area), session))]
+    # Areas can share a weather station
+    obs_urls = set(obs_urls_by_area.values())
+    threads.extend(threading.Thread(target=run, args=(
+        obs_url, get_min_observed, obs_url, session)) for obs_url in obs_urls)
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    min_forecasts = results["forecast"]
+    return dict((aac, (results[obs_url], min_forecasts[aac]))
+                for aac, obs_url in obs_urls_by_area.items()
+                if min_forecasts[aac] is not None)
+
+
+def get_min_temp_phrases(bom_forecast_url, obs_urls_by_area):
+    """{aac: min temperature phrase} for each area, from one forecast parse"""
+    return dict(
+        (aac, get_min_temp_phrase_from_values(*values))
+        for aac, values in get_min_observed_and_forecasted_batch(
+            bom_forecast_url, obs_urls_by_area).items())
+
+
+def get_min_observed_and_forecasted(bom_obs_url, bom_forecast_url, bom_forecast_area):
+    values = get_min_observed_and_forecasted_batch(
+        bom_forecast_url, {bom_forecast_area: bom_obs_url})
+    if bom_forecast_area not in values:
+        raise ValueError("No minimum temperature forecast for %s" %
+                         (bom_forecast_area,))
+    return values[bom_forecast_area]
 
 if __name__ == "__main__":
     print get_min_temp_phrase_from_values(*get_min_observed_and_forecasted(